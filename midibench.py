@@ -0,0 +1,173 @@
+import argparse
+import json
+import pathlib
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from midilib import ANYKEY,facet_columns,key_names,MidiLibrarian,scan_task
+
+# {{{1 arguments
+
+args = argparse.ArgumentParser(description="generate a synthetic midi library and time scanning and queries")
+args.add_argument("--files",type=int,default=2000)
+args.add_argument("--tracks",type=int,default=4)
+args.add_argument("--density",type=int,default=200,help="note events per track")
+args.add_argument("--dirs",type=int,default=50)
+args.add_argument("--seed",type=int,default=0)
+args.add_argument("--jobs",type=int,default=1)
+args.add_argument("--queries",type=int,default=200)
+args.add_argument("--corpus",default=None,help="keep the generated library here instead of a temp dir")
+args.add_argument("--json",default=None,help="append results as one json line to this file")
+
+# }}}1
+# {{{1 synthetic library
+
+def varlen(n):
+    out = bytearray([n & 0x7f])
+    n >>= 7
+    while n:
+        out.insert(0,0x80 | (n & 0x7f))
+        n >>= 7
+    return bytes(out)
+
+def chunk(name,data):
+    return name + len(data).to_bytes(4,"big") + data
+
+def synthetic_track(rng,index,density):
+    channel = index % 16
+    data = bytearray()
+    name = "track {}".format(index).encode()
+    data += b"\x00\xff\x03" + varlen(len(name)) + name
+    if index == 0:
+        data += b"\x00\xff\x51\x03\x07\xa1\x20"
+        if rng.random() < 0.4:
+            sf,mi = rng.choice(list(key_names))
+            data += bytes([0,0xff,0x59,2,sf & 0xff,mi])
+    if rng.random() < 0.1:
+        data += b"\x00\xf0\x05\x7e\x7f\x09\x01\xf7"
+    running = rng.random() < 0.5
+    base = rng.randrange(36,72)
+    for _ in range(density):
+        note = min(127,base + rng.choice((0,2,4,5,7,9,11,12)))
+        data += varlen(rng.choice((0,0,60,120,240,480)))
+        data += bytes([0x90 | channel,note,rng.randrange(1,128)])
+        data += varlen(rng.choice((60,120,240)))
+        if running:
+            data += bytes([note,0])
+        else:
+            data += bytes([0x80 | channel,note,64])
+    data += b"\x00\xff\x2f\x00"
+    return chunk(b"MTrk",bytes(data))
+
+def synthetic_midi(rng,tracks,density):
+    ntracks = rng.randint(1,tracks)
+    header = chunk(b"MThd",(1).to_bytes(2,"big") + ntracks.to_bytes(2,"big") + (480).to_bytes(2,"big"))
+    return header + b"".join(
+        synthetic_track(rng,i,rng.randint(0,density * 2)) for i in range(ntracks))
+
+def generate(root,files,tracks,density,dirs,seed):
+    rng = random.Random(seed)
+    root = pathlib.Path(root)
+    total = 0
+    for i in range(files):
+        d = root / "set{:03d}".format(i % dirs) / "sub{}".format(i % 3)
+        d.mkdir(parents=True,exist_ok=True)
+        data = synthetic_midi(rng,tracks,density)
+        (d / "file{:06d}.mid".format(i)).write_bytes(data)
+        total += len(data)
+    return total
+
+# }}}1
+# {{{1 benchmarks
+
+def timed(fn,*a,**kw):
+    t = time.perf_counter()
+    result = fn(*a,**kw)
+    return time.perf_counter() - t,result
+
+def percentile(samples,p):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1,int(len(samples) * p))]
+
+def bench_scan(root,dbfile,jobs,files,nbytes):
+    cx = MidiLibrarian(dbfile)
+    elapsed,stats = timed(cx.populate_from,root,jobs=jobs)
+    rescan,_ = timed(cx.populate_from,root,jobs=jobs)
+    cx.close()
+    return {
+        "scan_seconds":elapsed,
+        "files_per_sec":files / elapsed,
+        "mb_per_sec":nbytes / elapsed / 1e6,
+        "failed":stats["failed"],
+        "rescan_seconds":rescan}
+
+def bench_insert(root):
+    paths = [str(p) for p in sorted(pathlib.Path(root).rglob("*.mid"))]
+    rows = [scan_task((p,0,0,None)) for p in paths]
+    cx = MidiLibrarian(":memory:")
+    elapsed,_ = timed(lambda:(cx.insert_midis(rows),cx.commit()))
+    cx.close()
+    return {"insert_rows_per_sec":len(rows) / elapsed}
+
+def bench_queries(dbfile,queries,seed):
+    rng = random.Random(seed)
+    cx = MidiLibrarian(dbfile)
+    values = cx.facet_counts({})
+    facet_ms = list()
+    page_ms = list()
+    similar_ms = list()
+    ids = list(cx.cu.execute("select id from midis"))
+    for _ in range(queries):
+        filters = {c:ANYKEY for c in facet_columns}
+        for c in rng.sample(facet_columns,rng.randint(0,3)):
+            if values[c]:
+                filters[c] = str(rng.choice(values[c])[0])
+        elapsed,_ = timed(cx.facet_counts,filters)
+        facet_ms.append(elapsed * 1000)
+        elapsed,_ = timed(cx.datatree_page,filters)
+        page_ms.append(elapsed * 1000)
+        elapsed,_ = timed(cx.similar_view,rng.choice(ids))
+        similar_ms.append(elapsed * 1000)
+    cx.close()
+    return {
+        "facet_ms_median":statistics.median(facet_ms),
+        "facet_ms_p95":percentile(facet_ms,0.95),
+        "page_ms_median":statistics.median(page_ms),
+        "page_ms_p95":percentile(page_ms,0.95),
+        "similar_ms_median":statistics.median(similar_ms),
+        "similar_ms_p95":percentile(similar_ms,0.95)}
+
+def main(argv=None):
+    ns = args.parse_args(argv)
+    workdir = pathlib.Path(tempfile.mkdtemp(prefix="midibench"))
+    root = pathlib.Path(ns.corpus) if ns.corpus else workdir / "library"
+    try:
+        if root.is_dir() and any(root.iterdir()):
+            nbytes = sum(p.stat().st_size for p in root.rglob("*.mid"))
+        else:
+            nbytes = generate(root,ns.files,ns.tracks,ns.density,ns.dirs,ns.seed)
+        files = sum(1 for p in root.rglob("*.mid"))
+        dbfile = workdir / "bench.db"
+        results = {"files":files,"mb":nbytes / 1e6}
+        results.update(bench_scan(root,dbfile,ns.jobs,files,nbytes))
+        results.update(bench_insert(root))
+        results.update(bench_queries(dbfile,ns.queries,ns.seed))
+    finally:
+        shutil.rmtree(workdir)
+    for name,value in results.items():
+        print("{:<22}{:>14.3f}".format(name,value))
+    if ns.json:
+        with open(ns.json,"a") as f:
+            f.write(json.dumps(dict(
+                results,
+                time=time.strftime("%Y-%m-%dT%H:%M:%S"),
+                args=vars(ns))) + "\n")
+    return 0
+
+# }}}1
+
+if __name__ == "__main__":
+    sys.exit(main())
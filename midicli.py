@@ -0,0 +1,200 @@
+import argparse
+import os
+import re
+import sys
+import pathlib
+import midiprof
+from midilib import ANYKEY,facet_columns,range_columns,key_codes,parse_range,MidiLibrary,_DBFILE
+
+# {{{1 arguments
+
+naturals = dict(c=0,d=2,e=4,f=5,g=7,a=9,b=11)
+
+def pitch_classes(text):
+    # "C,Eb, g#" -> bit mask; sharps and flats, any case, spaces allowed
+    mask = 0
+    for name in text.split(","):
+        m = re.fullmatch(r"([a-g])(#*|b*)",name.strip().lower())
+        if not m:
+            raise argparse.ArgumentTypeError("not a pitch class: {!r}".format(name.strip()))
+        letter,accidentals = m.groups()
+        pc = naturals[letter] + accidentals.count("#") - accidentals.count("b")
+        mask |= 1 << pc % 12
+    return mask
+
+def value_range(text):
+    if text == ANYKEY:
+        return text
+    try:
+        return parse_range(text)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+args = argparse.ArgumentParser(description="scan and query the midi library without the gui")
+args.add_argument("--db",default=_DBFILE)
+midiprof.add_arguments(args)
+commands = args.add_subparsers(dest="command",required=True)
+
+scan = commands.add_parser("scan")
+scan.add_argument("rootdir")
+scan.add_argument("--jobs",type=int,default=1)
+
+watch = commands.add_parser("watch",help="keep the library up to date as files change")
+watch.add_argument("rootdir")
+watch.add_argument("--interval",type=float,default=2.0,help="seconds between directory checks when polling")
+watch.add_argument("--full-interval",type=float,default=600.0,help="seconds between full stat passes when polling")
+
+estimate = commands.add_parser("estimate")
+
+fixkeys = commands.add_parser("fix-keys",help="write key signatures into files")
+fixkeys.add_argument("paths",nargs="*")
+fixkeys.add_argument("--flagged",action="store_true",help="every file whose key signature disagrees with its estimated key")
+fixkeys.add_argument("--key",default=None,help="write this key instead of each file's estimated key")
+fixkeys.add_argument("--jobs",type=int,default=1)
+fixkeys.add_argument("--dry-run",action="store_true")
+
+duplicates = commands.add_parser("duplicates")
+duplicates.add_argument("--notes",action="store_true",help="group by note content instead of file bytes")
+
+similar = commands.add_parser("similar")
+similar.add_argument("path")
+similar.add_argument("--limit",type=int,default=50)
+
+query = commands.add_parser("query")
+facets = commands.add_parser("facets")
+for p in (query,facets):
+    for c in facet_columns:
+        if c in range_columns:
+            p.add_argument("--" + c.replace("_","-"),dest=c,type=value_range,default=ANYKEY,
+                           help="value, or lo:hi range")
+        else:
+            p.add_argument("--" + c.replace("_","-"),dest=c,default=ANYKEY)
+    p.add_argument("--uses-only",dest="pcs_only",type=pitch_classes,default=None,
+                   help="comma separated pitch classes, e.g. C,D,E,G,A or C,Eb,Bb")
+    p.add_argument("--contains-all",dest="pcs_all",type=pitch_classes,default=None,help="comma separated pitch classes")
+    p.add_argument("--search",default="",help="words to look for in file and directory names")
+query.add_argument("--limit",type=int,default=None)
+
+# }}}1
+# {{{1 commands
+
+def report(kind,stats):
+    print(
+        "{}: found {found}, unchanged {skipped}, parsed {parsed}/{queued}, failed {failed}, removed {removed}".format(
+            kind,**stats),
+        file=sys.stderr)
+
+def do_scan(cx,ns):
+    cx.populate_from(
+        pathlib.Path(ns.rootdir),
+        jobs=ns.jobs,
+        progress=lambda kind,stats:kind in ("commit","done") and report(kind,stats))
+    return 0
+
+def do_watch(cx,ns):
+    from midiwatch import LibraryWatcher
+    import queue
+    events = queue.Queue()
+    watcher = LibraryWatcher(events,pathlib.Path(ns.rootdir),ns.db,
+                             interval=ns.interval,full_interval=ns.full_interval)
+    watcher.start()
+    try:
+        while True:
+            kind,stats = events.get()
+            if kind == "error":
+                print("watch failed:",stats,file=sys.stderr)
+                return 1
+            print(
+                "{}: parsed {parsed}, unchanged {skipped}, failed {failed}, removed {removed}".format(
+                    ", ".join(stats["paths"]),**stats),
+                file=sys.stderr)
+    except KeyboardInterrupt:
+        watcher.stop.set()
+        return 0
+
+def do_estimate(cx,ns):
+    print("estimated {} files".format(cx.estimate_keys()),file=sys.stderr)
+    return 0
+
+def do_fix_keys(cx,ns):
+    paths = [os.path.abspath(p) for p in ns.paths]
+    if not paths and not ns.flagged:
+        print("give some paths or --flagged",file=sys.stderr)
+        return 2
+    if ns.key is not None:
+        if ns.key not in key_codes:
+            print("unknown key: {} (try one of {})".format(ns.key," ".join(key_codes)),file=sys.stderr)
+            return 2
+        items = [(path,ns.key) for path,est_key in cx.key_fixes()] if ns.flagged else [(p,ns.key) for p in paths]
+    else:
+        items = cx.key_fixes(paths or None)
+    for path,key in items:
+        print("{}\t{}".format(key,path))
+    if ns.dry_run:
+        return 0
+    stats = cx.write_key_signatures(items,jobs=ns.jobs)
+    for path,error in stats["conflicts"]:
+        print("not written: {}: {}".format(path,error),file=sys.stderr)
+    print("wrote {done}/{total}, {failed} failed".format(**stats),file=sys.stderr)
+    return 1 if stats["failed"] else 0
+
+def do_duplicates(cx,ns):
+    groups = cx.duplicates_view("notehash" if ns.notes else "filehash")
+    for digest,files in groups.items():
+        print(digest)
+        for oid,path,name in files:
+            print("\t{}".format(path))
+    return 0
+
+def do_similar(cx,ns):
+    row = cx.execute("select id from midis where path=?",(os.path.abspath(ns.path),)).fetchone()
+    if not row:
+        print("not in the library: {}".format(ns.path),file=sys.stderr)
+        return 1
+    for oid,path,name,score in cx.similar_view(row[0],limit=ns.limit):
+        print("{}\t{}".format(score,path))
+    return 0
+
+def get_filters(ns):
+    filters = {c:getattr(ns,c) for c in facet_columns}
+    filters["search"] = ns.search
+    for option in ("pcs_only","pcs_all"):
+        if getattr(ns,option) is not None:
+            filters[option] = getattr(ns,option)
+    return filters
+
+def do_query(cx,ns):
+    filters = get_filters(ns)
+    after = None
+    shown = 0
+    while ns.limit is None or shown < ns.limit:
+        rows = cx.datatree_page(filters,after=after,limit=1000)
+        if not rows:
+            break
+        for oid,path,name in rows[:None if ns.limit is None else ns.limit - shown]:
+            print(path)
+            shown += 1
+        after = rows[-1][0]
+    return 0
+
+def do_facets(cx,ns):
+    filters = get_filters(ns)
+    for facet,counts in cx.facet_counts(filters).items():
+        print(facet)
+        for value,count in counts:
+            print("\t{}\t{}".format(value,count))
+    return 0
+
+def main(argv=None):
+    ns = args.parse_args(argv)
+    midiprof.setup(ns)
+    cx = MidiLibrary(ns.db).cx
+    try:
+        return {"scan":do_scan,"watch":do_watch,"estimate":do_estimate,"fix-keys":do_fix_keys,"duplicates":do_duplicates,"similar":do_similar,"query":do_query,"facets":do_facets}[ns.command](cx,ns)
+    finally:
+        cx.close()
+
+# }}}1
+
+if __name__ == "__main__":
+    sys.exit(main())
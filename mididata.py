@@ -1,15 +1,15 @@
 import argparse
 import os
-import sys
-import sqlite3
 import pathlib
 import subprocess
-import itertools
-import shutil
-import mido
+import queue
+import midiprof
+from midiprof import stage
+from midilib import ANYKEY,pitch_names,split_member,bucket_edges,histogram,MidiLibrary,QueryCache,ScanWorker,FileOperation,KeyWriter
 import tkinter as tk
 import tkinter.ttk as ttk
 import tkinter.filedialog as filedialog
+import tkinter.messagebox as messagebox
 
 # {{{1 variables, arguments, utility functions
 home = pathlib.Path.home()
@@ -30,402 +30,395 @@ args = argparse.ArgumentParser()
 
 args.add_argument("--scan",action="store_true")
 args.add_argument("--rootdir",default=_ROOTDIR)
+args.add_argument("--jobs",type=int,default=1)
+args.add_argument("--watch",action="store_true",help="keep the library up to date while the app is open")
+midiprof.add_arguments(args)
 
 ns = args.parse_args()
-
-note_d = {a:b for (a,b) in zip(
-    range(128),
-    itertools.cycle(["C","C#","D","D#","E","F","F#","G","G#","A","A#","B"])
-)}
-
-_ANYKEY = "*ANY*"
+midiprof.setup(ns)
 
 pack_left = dict(fill="both",expand=True,side="left")
 pack_right= dict(fill="both",expand=True,side="right")
 pack_normal= dict(fill="both",expand=True)
 pack_scroll = dict(fill="y",side="right",anchor="w")
 
+past_tense = dict(copy="copied",move="moved",keys="rewritten")
+
 def scrollconfig(scroll,bar):
     scroll.config(yscrollcommand=bar.set)
     bar.config(command=scroll.yview)
 
-# }}}1
-# {{{1 MidiLibrarian
-class MidiLibrarian(sqlite3.Connection):
-    ddl = """
-    create table if not exists midis (
-    id integer primary key,
-    path text,
-    dir text,
-    name text,
-    keys text,
-    notecount integer,
-    noteset text,
-    different_notes integer,
-    different_times integer,
-    tracks integer,
-    errors text,
-    unique (path) on conflict replace);
-    """
-    def __init__(self,name,**kwargs):
-        super().__init__(name,**kwargs)
-        self.executescript(self.ddl)
-        self.commit()
-    @property
-    def cu(self):
-        cu = self.cursor()
-        cu.row_factory = lambda c,r:r[0]
-        return cu
-    def populate_from(self,path):
-        for r,ds,fs in os.walk(path):
-            root = pathlib.Path(r)
-            print("root:",root)
-            for f in fs:
-                if f.endswith(".mid"):
-                    error = False
-                    fpath = root/f
-                    print("\tfpath:",fpath)
-                    path = str(fpath)
-                    _dir = str(fpath.parent)
-                    name = str(fpath.stem)
-                    try:
-                        mid = mido.MidiFile(fpath)
-                    except OSError:
-                        error = str(sys.exc_info()[1])
-                    if not error:
-                        different_notes = set()
-                        different_times = set()
-                        tracks = len(mid.tracks)
-                        note_set = set()
-                        key_sigs = set()
-                        note_count = 0
-                        for track in mid.tracks:
-                            for message in track:
-                                if message.type == "key_signature":
-                                    key_sigs.add(message.key)
-                                if message.type == "note_on":
-                                    different_notes.add(message.note)
-                                    different_times.add(message.time)
-                                    note_set.add(note_d[message.note])
-                                    note_count += 1
-
-                        if not len(key_sigs):
-                            key_sigs.add("NONE")
-                        self.execute(
-                            "insert into midis"
-                            " (path,dir,name,keys,notecount,noteset,different_notes,different_times,tracks)"
-                            " values (?,?,?,?,?,?,?,?,?)",(
-                                path,
-                                _dir,
-                                name,
-                                "_".join(sorted(key_sigs)),
-                                note_count,
-                                str(sorted(note_set)),
-                                len(different_notes),
-                                len(different_times),
-                                tracks))
-                    else:
-                        self.execute(
-                            "insert into midis"
-                            " (path,dir,name,errors) values (?,?,?,?)",
-                            (
-                                path,
-                                _dir,
-                                name,
-                                error)
-                            )
-        self.commit()
-    def keys_view(self):
-        return [_ANYKEY] + list(self.cu.execute("select distinct keys from midis order by keys"))
-    def notecounts_view(self):
-        return [_ANYKEY] + list(self.cu.execute("select distinct notecount from midis order by notecount"))
-    def different_notes_view(self):
-        return [_ANYKEY] + list(self.cu.execute("select distinct different_notes from midis order by different_notes"))
-    def different_times_view(self):
-        return [_ANYKEY] + list(self.cu.execute("select distinct different_times from midis order by different_times"))
-    def trackcount_view(self):
-        return [_ANYKEY] + list(self.cu.execute("select distinct tracks from midis order by tracks"))
-    def datatree_view(self,key,notecount,different_notes,different_times,trackcount):
-        whereclauses = list()
-        qargs = list()
-        if (
-            (key == _ANYKEY) and
-            (notecount == _ANYKEY) and
-            (different_notes == _ANYKEY) and
-            (different_times == _ANYKEY) and
-            (trackcount == _ANYKEY)):
-            sql = "select id,path,name from midis"
-        else:
-            sqlfmt = "select id,path,name from midis where {}"
-            if key != _ANYKEY:
-                whereclauses.append("keys=?")
-                qargs.append(key)
-            if notecount != _ANYKEY:
-                whereclauses.append("notecount=?")
-                qargs.append(notecount)
-            if different_notes != _ANYKEY:
-                whereclauses.append("different_notes=?")
-                qargs.append(different_notes)
-            if different_times != _ANYKEY:
-                whereclauses.append("different_times=?")
-                qargs.append(different_times)
-            if trackcount != _ANYKEY:
-                whereclauses.append("tracks=?")
-                qargs.append(trackcount)
-            sql = sqlfmt.format(" and ".join(whereclauses))
-        print("sql:",sql)
-        print("qargs:",qargs)
-        if not qargs:
-            return list(self.execute(sql))
-        else:
-            return list(self.execute(sql,qargs))
-
-# }}}1
-# {{{1 MidiLibrary
-
-class MidiLibrary:
-    _handle = None
-    @property
-    def cx(self):
-        if not self._handle:
-            self._handle = sqlite3.connect(
-                _DBFILE,
-                factory=MidiLibrarian)
-        return self._handle
+def reveal(path):
+    # for a file inside a zip, show the zip
+    path = split_member(str(path))[0]
+    midiprof.trace("path:",path)
+    subprocess.run("explorer /select,\"{}\"".format(path),shell=True)
 
 # }}}1
-# {{{1 DifferentNotesFrame
-
-class DifferentNotesFrame(ttk.LabelFrame):
-    def update_view(self):
-        if not len(self.listv.get()):
-            print("DifferentNotesFrame View Update...",end="")
-            self.listv.set(self.winfo_toplevel().db.cx.different_notes_view())
-            print("Complete")
-        else:
-            print("DifferentNotesFrame View Update Skipped")
+# {{{1 FacetFrame
+
+class FacetFrame(ttk.LabelFrame):
+    facet = None
+    def update_view(self,counts):
+        active = self.active_item.get()
+        total = sum(count for value,count in counts)
+        self.values = [ANYKEY] + [str(value) for value,count in counts]
+        labels = ["{} ({})".format(ANYKEY,total)] + [
+            "{} ({})".format(value,count) for value,count in counts]
+        if active and active not in self.values:
+            self.values.append(active)
+            labels.append("{} (0)".format(active))
+        self.listv.set(labels)
+        self.listbox.selection_clear(0,"end")
+        if active in self.values:
+            index = self.values.index(active)
+            self.listbox.selection_set(index)
+            self.listbox.see(index)
     def selection_callback(self,event):
         index = self.listbox.curselection()
         if len(index):
-            item = self.listbox.get(index[0])
-            self.active_item.set(item)
-            self.winfo_toplevel().update_ui()
+            item = self.values[index[0]]
+            if item != self.active_item.get():
+                self.active_item.set(item)
+                self.winfo_toplevel().update_ui()
+    def filter_value(self):
+        return self.active_item.get()
     def __init__(self,master):
         super().__init__(master)
+        self.values = list()
         self.listv = tk.StringVar()
-        self.active_item = tk.StringVar()
+        self.active_item = tk.StringVar(value=ANYKEY)
         self.framelabel = tk.Label(self,textvariable=self.active_item)
         self.configure(labelwidget=self.framelabel)
-        self.listbox = tk.Listbox(self,listvariable=self.listv,width=16)
+        self.listbox = tk.Listbox(self,listvariable=self.listv,width=16,exportselection=False)
         self.listbox.pack(**pack_left)
         self.scrollbar = tk.Scrollbar(self)
         self.scrollbar.pack(**pack_scroll)
         scrollconfig(self.listbox,self.scrollbar)
         self.listbox.bind("<<ListboxSelect>>",self.selection_callback)
 
-# }}}1
-# {{{1 NoteCountFrame
+class KeyFrame(FacetFrame):
+    facet = "keys"
 
-class DifferentTimesFrame(ttk.LabelFrame):
-    def update_view(self):
-        if not len(self.listv.get()):
-            print("DifferentTimesFrame View Update...",end="")
-            self.listv.set(self.winfo_toplevel().db.cx.different_times_view())
-            print("Complete")
-        else:
-            print("DifferentTimesFrame View Update Skipped")
-    def selection_callback(self,event):
-        index = self.listbox.curselection()
-        if len(index):
-            item = self.listbox.get(index[0])
-            self.active_item.set(item)
-            self.winfo_toplevel().update_ui()
-    def __init__(self,master):
-        super().__init__(master)
-        self.listv = tk.StringVar()
-        self.active_item = tk.StringVar()
-        self.framelabel = tk.Label(self,textvariable=self.active_item)
-        self.configure(labelwidget=self.framelabel)
-        self.listbox = tk.Listbox(self,listvariable=self.listv,width=16)
-        self.listbox.pack(**pack_left)
-        self.scrollbar = tk.Scrollbar(self)
-        self.scrollbar.pack(**pack_scroll)
-        scrollconfig(self.listbox,self.scrollbar)
-        self.listbox.bind("<<ListboxSelect>>",self.selection_callback)
+class EstKeyFrame(FacetFrame):
+    facet = "est_key"
 
-# }}}1
-# {{{1 NoteCountFrame
-
-class NoteCountFrame(ttk.LabelFrame):
-    def update_view(self):
-        if not len(self.listv.get()):
-            print("NoteCountFrame View Update...",end="")
-            self.listv.set(self.winfo_toplevel().db.cx.notecounts_view())
-            # self.listbox.selection_set(0)
-            print("Complete")
-        else:
-            print("NoteCountFrame View Update Skipped")
-    def selection_callback(self,event):
-        index = self.listbox.curselection()
-        if len(index):
-            item = self.listbox.get(index[0])
-            self.active_item.set(item)
-            self.winfo_toplevel().update_ui()
-    def __init__(self,master):
-        super().__init__(master)
-        self.listv = tk.StringVar()
-        self.active_item = tk.StringVar()
-        self.framelabel = tk.Label(self,textvariable=self.active_item)
-        self.configure(labelwidget=self.framelabel)
-        self.listbox = tk.Listbox(self,listvariable=self.listv,width=16)
-        self.listbox.pack(**pack_left)
-        self.scrollbar = tk.Scrollbar(self)
-        self.scrollbar.pack(**pack_scroll)
-        scrollconfig(self.listbox,self.scrollbar)
-        self.listbox.bind("<<ListboxSelect>>",self.selection_callback)
+class KeyMismatchFrame(FacetFrame):
+    facet = "key_mismatch"
 
 # }}}1
-# {{{1 KeyFrame
-
-class KeyFrame(ttk.LabelFrame):
-    def update_view(self):
-        if not len(self.listv.get()):
-            print("KeyFrame View Update...",end="")
-            self.listv.set(self.winfo_toplevel().db.cx.keys_view())
-            print("Complete")
+# {{{1 RangeFrame
+
+class RangeFrame(ttk.LabelFrame):
+    facet = None
+    width = 180
+    height = 56
+    def update_view(self,counts):
+        bounds = self.winfo_toplevel().queries("facet_bounds",self.facet)
+        if bounds != self.bounds:
+            self.bounds = bounds
+            lo,hi = bounds
+            self.edges = bucket_edges(lo,hi) if lo is not None else list()
+        self.hist = histogram(counts,self.edges)
+        self.draw()
+    def bucket_at(self,x):
+        if not self.hist:
+            return None
+        return min(len(self.hist) - 1,max(0,int(x * len(self.hist) / self.width)))
+    def selected_buckets(self):
+        lo,hi = self.bounds_value()
+        return [i for i in range(len(self.hist))
+                if (lo is None or self.edges[i + 1] - 1 >= lo) and
+                   (hi is None or self.edges[i] <= hi)]
+    def draw(self):
+        self.canvas.delete("all")
+        if not self.hist:
+            return
+        top = max(self.hist) or 1
+        barwidth = self.width / len(self.hist)
+        active = self.bounds_value() != (None,None)
+        selected = set(self.selected_buckets()) if active else set()
+        for i,count in enumerate(self.hist):
+            barheight = (self.height - 2) * count / top
+            self.canvas.create_rectangle(
+                i * barwidth,self.height - barheight,(i + 1) * barwidth - 1,self.height,
+                fill="steelblue" if i in selected else "gray70",width=0)
+        self.canvas.create_text(2,2,anchor="nw",text=str(self.edges[0]),font="TkSmallCaptionFont")
+        self.canvas.create_text(
+            self.width - 2,2,anchor="ne",text=str(self.edges[-1] - 1),font="TkSmallCaptionFont")
+    def press_callback(self,event):
+        self.anchor = self.bucket_at(event.x)
+        self.drag_callback(event)
+    def drag_callback(self,event):
+        if self.anchor is None:
+            return
+        a,b = sorted((self.anchor,self.bucket_at(event.x)))
+        self.lo.set(str(self.edges[a]))
+        self.hi.set(str(self.edges[b + 1] - 1))
+        self.changed()
+    def release_callback(self,event):
+        self.anchor = None
+    def clear(self,*event_or_none):
+        self.lo.set("")
+        self.hi.set("")
+        self.changed()
+    def bounds_value(self):
+        values = list()
+        for var in (self.lo,self.hi):
+            try:
+                values.append(int(var.get()))
+            except ValueError:
+                values.append(None)
+        return tuple(values)
+    def filter_value(self):
+        value = self.bounds_value()
+        if value == (None,None):
+            return ANYKEY
+        return value
+    def changed(self,*event_or_none):
+        lo,hi = self.bounds_value()
+        if (lo,hi) == (None,None):
+            self.active_item.set(ANYKEY)
         else:
-            print("KeyFrame View Update Skipped")
-    def selection_callback(self,event):
-        index = self.listbox.curselection()
-        if len(index):
-            item = self.listbox.get(index[0])
-            self.active_item.set(item)
+            self.active_item.set("{} .. {}".format(
+                "" if lo is None else lo,"" if hi is None else hi))
+        self.draw()
+        # dragging fires a lot of motion events, only query once it settles
+        if self.pending is not None:
+            self.after_cancel(self.pending)
+        self.pending = self.after(100,self.apply)
+    def apply(self):
+        self.pending = None
+        value = self.filter_value()
+        if value != self.applied:
+            self.applied = value
             self.winfo_toplevel().update_ui()
     def __init__(self,master):
         super().__init__(master)
-        self.listv = tk.StringVar()
-        self.active_item = tk.StringVar()
+        self.bounds = None
+        self.edges = list()
+        self.hist = list()
+        self.anchor = None
+        self.pending = None
+        self.applied = ANYKEY
+        self.active_item = tk.StringVar(value=ANYKEY)
         self.framelabel = tk.Label(self,textvariable=self.active_item)
         self.configure(labelwidget=self.framelabel)
-        self.listbox = tk.Listbox(self,listvariable=self.listv,width=16)
-        self.listbox.pack(**pack_left)
-        self.scrollbar = tk.Scrollbar(self)
-        self.scrollbar.pack(**pack_scroll)
-        scrollconfig(self.listbox,self.scrollbar)
-        self.listbox.bind("<<ListboxSelect>>",self.selection_callback)
-
-# }}}1
-# {{{1 TrackCountFrame
-
-class TrackCountFrame(ttk.LabelFrame):
-    def update_view(self):
-        if not len(self.listv.get()):
-            print("TrackCountFrame View Update...",end="")
-            self.listv.set(self.winfo_toplevel().db.cx.trackcount_view())
-            print("Complete")
-        else:
-            print("TrackCountFrame View Update Skipped")
-    def selection_callback(self,event):
-        index = self.listbox.curselection()
-        if len(index):
-            item = self.listbox.get(index[0])
-            self.active_item.set(item)
-            self.winfo_toplevel().update_ui()
-    def __init__(self,master):
-        super().__init__(master)
-        self.listv = tk.StringVar()
-        self.active_item = tk.StringVar()
-        self.framelabel = tk.Label(self,textvariable=self.active_item)
-        self.configure(labelwidget=self.framelabel)
-        self.listbox = tk.Listbox(self,listvariable=self.listv,width=16)
-        self.listbox.pack(**pack_left)
-        self.scrollbar = tk.Scrollbar(self)
-        self.scrollbar.pack(**pack_scroll)
-        scrollconfig(self.listbox,self.scrollbar)
-        self.listbox.bind("<<ListboxSelect>>",self.selection_callback)
+        self.canvas = tk.Canvas(self,width=self.width,height=self.height,highlightthickness=0)
+        self.canvas.grid(row=0,column=0,columnspan=3)
+        self.lo = tk.StringVar()
+        self.hi = tk.StringVar()
+        for column,var in ((0,self.lo),(1,self.hi)):
+            entry = tk.Entry(self,textvariable=var,width=8)
+            entry.grid(row=1,column=column,sticky="ew")
+            entry.bind("<Return>",self.changed)
+            entry.bind("<FocusOut>",self.changed)
+        tk.Button(self,text="any",command=self.clear).grid(row=1,column=2)
+        self.canvas.bind("<ButtonPress-1>",self.press_callback)
+        self.canvas.bind("<B1-Motion>",self.drag_callback)
+        self.canvas.bind("<ButtonRelease-1>",self.release_callback)
+        self.canvas.bind("<Double-Button-1>",self.clear)
+
+class NoteCountFrame(RangeFrame):
+    facet = "notecount"
+
+class DifferentNotesFrame(RangeFrame):
+    facet = "different_notes"
+
+class DifferentTimesFrame(RangeFrame):
+    facet = "different_times"
+
+class TrackCountFrame(RangeFrame):
+    facet = "tracks"
 
 # }}}1
 # {{{1 DataFrame
 
 class DataFrame(ttk.LabelFrame):
+    pagesize = 200
+    maxpages = 3
     def __init__(self,master):
         super().__init__(master)
+        self.filters = dict()
+        self.selected = dict()
+        self.total = 0
+        self.more_before = False
+        self.more_after = False
+        self.loading = False
         self.active_item = tk.StringVar()
         self.framelabel = tk.Label(self,textvariable=self.active_item)
         self.configure(labelwidget=self.framelabel)
+        self.search = tk.StringVar()
+        self.search_pending = None
+        self.searchentry = tk.Entry(self,textvariable=self.search)
+        self.searchentry.pack(fill="x",side="top")
+        self.searchentry.bind("<Escape>",lambda event:self.search.set(""))
+        self.search.trace_add("write",self.search_changed)
         self.tree = ttk.Treeview(self,show="tree",selectmode="extended")
         self.tree.pack(**pack_left)
         self.scrollbar = tk.Scrollbar(self)
         self.scrollbar.pack(**pack_scroll)
-        scrollconfig(self.tree,self.scrollbar)
+        self.tree.config(yscrollcommand=self.scroll_callback)
+        self.scrollbar.config(command=self.tree.yview)
         self.tree.bind("<<TreeviewSelect>>",self.selection_callback)
+        self.tree.bind("<Button-1>",self.click_callback)
+        self.tree.bind("<Shift-Button-1>",lambda event:None)
+        self.tree.bind("<Control-Button-1>",lambda event:None)
         self.tree.bind("<Double-1>",self.doubleclick_callback)
         self.tree.bind("<Control-.>",self.copy_selected_to)
+        self.tree.bind("<Control-f>",self.find_similar)
+        self.tree.bind("<Control-a>",self.select_all)
+        self.tree.bind("<Control-Home>",self.first_page)
+        self.tree.bind("<Control-End>",self.last_page)
+    def search_changed(self,*args):
+        # wait for a pause in typing before querying
+        if self.search_pending is not None:
+            self.after_cancel(self.search_pending)
+        self.search_pending = self.after(250,self.search_apply)
+    def search_apply(self):
+        self.search_pending = None
+        self.winfo_toplevel().update_ui()
     def update_view(self):
-        print("DataFrame View Update")
+        filters = self.winfo_toplevel().mainframe.filters()
+        changed = filters != self.filters
+        self.filters = filters
+        self.total = self.winfo_toplevel().queries("datatree_count",self.filters)
+        if changed:
+            self.selected.clear()
+            self.first_page()
+        else:
+            # the data changed under us (scan, watch, file operation):
+            # stay where we are and keep what is selected
+            self.reload_page()
+        self.active_item.set(" | ".join(
+            ["{}:{}".format(k,"{}..{}".format(*("" if b is None else b for b in v))
+                            if isinstance(v,tuple) else v)
+             for k,v in self.filters.items() if v not in (ANYKEY,"")] +
+            ["{} files".format(self.total)]))
+    def show_rows(self,rows,index="end"):
+        midiprof.count("rows rendered",len(rows))
+        with stage("render rows"):
+            for oid,path,name in rows:
+                iid = str(oid)
+                self.tree.insert("",index,iid=iid,text=name,values=(oid,path))
+                if index != "end":
+                    index += 1
+                if oid in self.selected:
+                    self.tree.selection_add(iid)
+    def first_page(self,*event_or_none):
+        rows = self.winfo_toplevel().queries("datatree_page",self.filters,limit=self.pagesize+1)
+        self.tree.delete(*self.tree.get_children())
+        self.more_before = False
+        self.more_after = len(rows) > self.pagesize
+        self.show_rows(rows[:self.pagesize])
+        self.tree.yview_moveto(0)
+    def reload_page(self):
+        children = self.tree.get_children()
+        if not children:
+            return self.first_page()
+        if self.selected:
+            # drop rows that are gone, pick up new paths of moved ones
+            self.selected = dict(self.winfo_toplevel().db.cx.datatree_selected(self.filters,self.selected))
+        top = self.tree.yview()[0]
+        rows = self.winfo_toplevel().queries(
+            "datatree_page",self.filters,after=int(children[0])-1,limit=len(children)+1)
+        if not rows:
+            return self.last_page()
+        self.tree.delete(*children)
+        self.more_before = bool(self.winfo_toplevel().queries(
+            "datatree_page",self.filters,before=rows[0][0],limit=1))
+        self.more_after = len(rows) > len(children)
+        self.show_rows(rows[:len(children)])
+        self.tree.yview_moveto(top)
+    def last_page(self,*event_or_none):
+        rows = self.winfo_toplevel().queries("datatree_page",self.filters,reverse=True,limit=self.pagesize+1)
         self.tree.delete(*self.tree.get_children())
-        print("Tree Cleared")
-        filterframe = self.winfo_toplevel().mainframe.filterframe
-        key = filterframe.keyframe.active_item.get()
-        notecount = filterframe.notecountframe.active_item.get()
-        different_notes = filterframe.different_notesframe.active_item.get()
-        different_times = filterframe.different_timesframe.active_item.get()
-        trackcount = filterframe.trackcountframe.active_item.get()
-        for oid,path,name in self.winfo_toplevel().db.cx.datatree_view(key,notecount,different_notes,different_times,trackcount):
-            self.tree.insert("","end",text=name,values=(oid,path))
-        self.active_item.set(
-            "key(s):{} | notecount:{} | different notes:{} | different times:{} | track count:{}".format(
-                key,notecount,different_notes,different_times,trackcount))
+        self.more_before = len(rows) > self.pagesize
+        self.more_after = False
+        self.show_rows(rows[-self.pagesize:])
+        self.tree.yview_moveto(1)
+    def load_after(self):
+        self.loading = False
+        children = self.tree.get_children()
+        if not (self.more_after and children):
+            return
+        rows = self.winfo_toplevel().queries(
+            "datatree_page",self.filters,after=int(children[-1]),limit=self.pagesize+1)
+        self.more_after = len(rows) > self.pagesize
+        rows = rows[:self.pagesize]
+        self.show_rows(rows)
+        excess = len(children) + len(rows) - self.pagesize*self.maxpages
+        if excess > 0:
+            self.tree.delete(*children[:excess])
+            self.tree.yview_scroll(-excess,"units")
+            self.more_before = True
+    def load_before(self):
+        self.loading = False
+        children = self.tree.get_children()
+        if not (self.more_before and children):
+            return
+        rows = self.winfo_toplevel().queries(
+            "datatree_page",self.filters,before=int(children[0]),reverse=True,limit=self.pagesize+1)
+        self.more_before = len(rows) > self.pagesize
+        rows = rows[-self.pagesize:]
+        self.show_rows(rows,0)
+        self.tree.yview_scroll(len(rows),"units")
+        excess = len(children) + len(rows) - self.pagesize*self.maxpages
+        if excess > 0:
+            self.tree.delete(*children[-excess:])
+            self.more_after = True
+    def scroll_callback(self,first,last):
+        self.scrollbar.set(first,last)
+        if self.loading:
+            return
+        if float(last) >= 0.95 and self.more_after:
+            self.loading = True
+            self.after_idle(self.load_after)
+        elif float(first) <= 0.05 and self.more_before:
+            self.loading = True
+            self.after_idle(self.load_before)
+    def click_callback(self,event):
+        self.selected.clear()
+    def select_all(self,*event_or_none):
+        self.selected = dict(self.winfo_toplevel().db.cx.datatree_paths(self.filters))
+        self.tree.selection_set(self.tree.get_children())
+        return "break"
     def selection_callback(self,event):
-        selection = self.tree.selection()
-        print("len(selection):",len(selection))
-        item_values = self.tree.item(selection,"values")
-        path = item_values[1]
-        self.active_item.set(path)
+        selection = set(self.tree.selection())
+        for iid in self.tree.get_children():
+            if iid in selection:
+                self.selected[int(iid)] = self.tree.item(iid,"values")[1]
+            else:
+                self.selected.pop(int(iid),None)
+        midiprof.trace("len(selection):",len(self.selected))
+        if len(self.selected) == 1:
+            self.active_item.set(next(iter(self.selected.values())))
+        else:
+            self.active_item.set("{} of {} files selected".format(len(self.selected),self.total))
+    def find_similar(self,*event_or_none):
+        iid = self.tree.focus() or next(iter(self.tree.selection()),None)
+        if iid:
+            SimilarWindow(self.winfo_toplevel(),int(iid),self.tree.item(iid,"text"))
+    def selected_paths(self):
+        return [pathlib.Path(path) for path in self.selected.values()]
     def doubleclick_callback(self,event):
         selection = self.tree.selection()
-        print("type(selection):",type(selection))
         for t in selection:
             item_values = self.tree.item(t,"values")
-            path = item_values[1]
-            print("path:",path)
-            subprocess.run("explorer /select,\"{}\"".format(path),shell=True)
-    def copy_selected_to(self,*event_or_none):
+            reveal(item_values[1])
+    def selected_to(self,op):
         t = filedialog.askdirectory()
-        print("t:",t)
         if not t:
             return
         target = pathlib.Path(t).resolve()
-        print("target:",target)
+        midiprof.trace("target:",target)
         if not target.is_dir():
             return
-        selected_files = list()
-        for iid in self.tree.selection():
-            item_values = self.tree.item(iid,"values")
-            path = item_values[1]
-            selected_files.append(pathlib.Path(path))
-        for p in selected_files:
-            if p.is_file():
-                print("p:",p)
-                shutil.copy(p,target)
+        self.winfo_toplevel().start_fileop(op,self.selected_paths(),target)
+    def copy_selected_to(self,*event_or_none):
+        self.selected_to("copy")
     def move_selected_to(self,*event_or_none):
-        t = filedialog.askdirectory()
-        print("t:",t)
-        if not t:
-            return
-        target = pathlib.Path(t).resolve()
-        print("target:",target)
-        if not target.is_dir():
-            return
-        selected_files = list()
-        for iid in self.tree.selection():
-            item_values = self.tree.item(iid,"values")
-            path = item_values[1]
-            selected_files.append(pathlib.Path(path))
-        for p in selected_files:
-            if p.is_file():
-                print("p:",p)
-                shutil.move(p,target)
+        self.selected_to("move")
 
 # }}}1
 # {{{1 ActionFrame
@@ -441,7 +434,175 @@ class ActionFrame(ttk.LabelFrame):
                                     text="Move to...",
                                     command=self.winfo_toplevel().mainframe.dataframe.move_selected_to)
         self.movebutton.pack()
-        
+        self.scanbutton = tk.Button(self,
+                                    text="Rescan",
+                                    command=self.winfo_toplevel().start_scan)
+        self.scanbutton.pack()
+        self.duplicatesbutton = tk.Button(self,
+                                    text="Duplicates...",
+                                    command=lambda:DuplicatesWindow(self.winfo_toplevel()))
+        self.duplicatesbutton.pack()
+        self.similarbutton = tk.Button(self,
+                                    text="Find similar...",
+                                    command=self.winfo_toplevel().mainframe.dataframe.find_similar)
+        self.similarbutton.pack()
+        self.fixkeysbutton = tk.Button(self,
+                                    text="Fix key signatures...",
+                                    command=self.winfo_toplevel().start_keyfix)
+        self.fixkeysbutton.pack()
+
+# }}}1
+# {{{1 ResultsWindow
+
+class ResultsWindow(tk.Toplevel):
+    def __init__(self,master,title):
+        super().__init__(master)
+        self.title(title)
+        self.geometry("900x600")
+        self.topframe = tk.Frame(self)
+        self.topframe.pack(fill="x")
+        self.tree = ttk.Treeview(self,columns=("detail",),selectmode="extended")
+        self.tree.heading("#0",text="name")
+        self.tree.heading("detail",text="")
+        self.tree.column("detail",width=120,stretch=False)
+        self.tree.pack(**pack_left)
+        self.scrollbar = tk.Scrollbar(self)
+        self.scrollbar.pack(**pack_scroll)
+        scrollconfig(self.tree,self.scrollbar)
+        self.tree.bind("<Double-1>",self.doubleclick_callback)
+        self.paths = dict()
+    def clear(self):
+        self.tree.delete(*self.tree.get_children())
+        self.paths.clear()
+    def add(self,parent,text,path=None,detail=""):
+        iid = self.tree.insert(parent,"end",text=text,values=(detail,),open=True)
+        if path:
+            self.paths[iid] = path
+        return iid
+    def doubleclick_callback(self,event):
+        for iid in self.tree.selection():
+            if iid in self.paths:
+                reveal(self.paths[iid])
+
+# }}}1
+# {{{1 DuplicatesWindow
+
+class DuplicatesWindow(ResultsWindow):
+    def __init__(self,master):
+        super().__init__(master,"Duplicates")
+        self.column = tk.StringVar(value="filehash")
+        for value,text in (
+                ("filehash","identical bytes"),
+                ("notehash","identical notes")):
+            tk.Radiobutton(self.topframe,text=text,value=value,variable=self.column,
+                           command=self.update_view).pack(side="left")
+        self.status = tk.StringVar()
+        tk.Label(self.topframe,textvariable=self.status).pack(side="right")
+        self.update_view()
+    def update_view(self):
+        self.clear()
+        groups = self.master.db.cx.duplicates_view(self.column.get())
+        for digest,files in groups.items():
+            parent = self.add("",digest,detail="{} files".format(len(files)))
+            for oid,path,name in files:
+                self.add(parent,name,path,os.path.dirname(path))
+        self.status.set("{} groups, {} files".format(
+            len(groups),sum(len(files) for files in groups.values())))
+
+# }}}1
+# {{{1 SimilarWindow
+
+class SimilarWindow(ResultsWindow):
+    def __init__(self,master,oid,name):
+        super().__init__(master,"Similar to {}".format(name))
+        self.tree.heading("detail",text="shared n-grams")
+        for oid,path,name,score in master.db.cx.similar_view(oid):
+            self.add("",name,path,score)
+
+# }}}1
+# {{{1 ProgressFrame
+
+class ProgressFrame(ttk.LabelFrame):
+    def __init__(self,master):
+        super().__init__(master)
+        self.configure(text="Scan")
+        self.status = tk.StringVar()
+        self.progressbar = ttk.Progressbar(self,orient="horizontal")
+        self.progressbar.pack(fill="x",expand=True,side="left")
+        self.statuslabel = tk.Label(self,textvariable=self.status,width=72,anchor="w")
+        self.statuslabel.pack(side="left")
+        self.cancelbutton = tk.Button(self,text="Cancel",command=self.winfo_toplevel().cancel_scan)
+        self.cancelbutton.pack(side="right")
+    def update_view(self,kind,stats):
+        if kind == "walk":
+            self.progressbar.configure(mode="indeterminate")
+            self.progressbar.step()
+            self.status.set("found {found} ({skipped} unchanged)".format(**stats))
+            return
+        self.progressbar.configure(mode="determinate",maximum=max(1,stats["queued"]),value=stats["parsed"])
+        self.status.set(
+            "{}: parsed {parsed}/{queued}, failed {failed}, removed {removed}, {rate:.1f} files/s, ETA {}".format(
+                kind,
+                "-" if stats["eta"] is None else "{:.0f}s".format(stats["eta"]),
+                **stats))
+
+# }}}1
+# {{{1 FileOpFrame
+
+class FileOpFrame(ttk.LabelFrame):
+    def __init__(self,master):
+        super().__init__(master)
+        self.configure(text="Files")
+        self.status = tk.StringVar()
+        self.progressbar = ttk.Progressbar(self,orient="horizontal")
+        self.progressbar.pack(fill="x",expand=True,side="left")
+        self.statuslabel = tk.Label(self,textvariable=self.status,width=72,anchor="w")
+        self.statuslabel.pack(side="left")
+        self.cancelbutton = tk.Button(self,text="Cancel",command=self.winfo_toplevel().cancel_fileop)
+        self.cancelbutton.pack(side="right")
+    def update_view(self,kind,stats):
+        self.progressbar.configure(maximum=max(1,stats["total"]),value=stats["done"] + stats["failed"])
+        self.status.set("{}: {} {done}/{total}, {failed} skipped".format(
+            kind,past_tense[stats["op"]],**stats))
+
+# }}}1
+# {{{1 ConflictsWindow
+
+class ConflictsWindow(ResultsWindow):
+    def __init__(self,master,stats):
+        super().__init__(master,"Not {}".format(past_tense[stats["op"]]))
+        self.tree.heading("detail",text="reason")
+        self.tree.column("detail",width=400)
+        for path,reason in stats["conflicts"]:
+            self.add("",pathlib.Path(path).name,path,reason)
+
+# }}}1
+# {{{1 PitchClassFrame
+
+class PitchClassFrame(ttk.LabelFrame):
+    def __init__(self,master):
+        super().__init__(master)
+        self.configure(text="Pitch Classes")
+        self.mode = tk.StringVar(value="any")
+        self.pcvars = [tk.IntVar() for pc in pitch_names]
+        for column,(mode,text) in enumerate((
+                ("any","ignore"),
+                ("only","uses only"),
+                ("all","contains all"))):
+            tk.Radiobutton(self,text=text,value=mode,variable=self.mode,
+                           command=self.changed).grid(row=0,column=column*2,columnspan=2,sticky="w")
+        for pc,name in enumerate(pitch_names):
+            tk.Checkbutton(self,text=name,variable=self.pcvars[pc],
+                           command=self.changed).grid(row=1+pc//6,column=pc%6,sticky="w")
+    def mask(self):
+        return sum(1 << pc for pc,v in enumerate(self.pcvars) if v.get())
+    def filters(self):
+        mode = self.mode.get()
+        if mode == "any":
+            return dict()
+        return {"pcs_" + mode:self.mask()}
+    def changed(self):
+        self.winfo_toplevel().update_ui()
 
 # }}}1
 # {{{1 FilterFrame
@@ -459,23 +620,49 @@ class FilterFrame(ttk.LabelFrame):
         self.notecountlable = tk.Label(self,text="Total Notes")
         self.notecountlable.pack()
         self.notecountframe = NoteCountFrame(self)
-        self.notecountframe.pack(**pack_normal)
+        self.notecountframe.pack(fill="x")
 
         self.diffnoteslabel = tk.Label(self,text="Distinct Notes")
         self.diffnoteslabel.pack()
         self.different_notesframe = DifferentNotesFrame(self)
-        self.different_notesframe.pack(**pack_normal)
+        self.different_notesframe.pack(fill="x")
 
         self.diffnoteslabel = tk.Label(self,text="Distinct Times")
         self.diffnoteslabel.pack()
         self.different_timesframe = DifferentTimesFrame(self)
-        self.different_timesframe.pack(**pack_normal)
+        self.different_timesframe.pack(fill="x")
 
         self.trackcountlabel = tk.Label(self,text="Track Count")
         self.trackcountlabel.pack()
         self.trackcountframe = TrackCountFrame(self)
-        self.trackcountframe.pack(**pack_normal)
-
+        self.trackcountframe.pack(fill="x")
+
+        self.estkeylabel = tk.Label(self,text="Estimated Key")
+        self.estkeylabel.pack()
+        self.estkeyframe = EstKeyFrame(self)
+        self.estkeyframe.pack(**pack_normal)
+
+        self.mismatchlabel = tk.Label(self,text="Key Signature Disagrees (1=yes)")
+        self.mismatchlabel.pack()
+        self.mismatchframe = KeyMismatchFrame(self)
+        self.mismatchframe.pack(**pack_normal)
+
+        self.pitchclassframe = PitchClassFrame(self)
+        self.pitchclassframe.pack(fill="x")
+
+        self.facetframes = (
+            self.keyframe,
+            self.notecountframe,
+            self.different_notesframe,
+            self.different_timesframe,
+            self.trackcountframe,
+            self.estkeyframe,
+            self.mismatchframe)
+
+    def filters(self):
+        filters = {f.facet:f.filter_value() for f in self.facetframes}
+        filters.update(self.pitchclassframe.filters())
+        return filters
 
 # }}}1
 # {{{1 MainFrame
@@ -487,20 +674,135 @@ class MainFrame(tk.Frame):
         self.filterframe.pack(fill="y",side="left")
         self.dataframe = DataFrame(self)
         self.dataframe.pack(**pack_right)
+    def filters(self):
+        filters = self.filterframe.filters()
+        filters["search"] = self.dataframe.search.get()
+        return filters
 
 # }}}1
 # {{{1 App
 
 class App(tk.Tk):
+    def start_scan(self):
+        if self.scanner:
+            return
+        self.scanner = ScanWorker(self.scan_events,ns.rootdir,_DBFILE,jobs=ns.jobs)
+        self.progressframe.pack(fill="x",expand=False)
+        self.progressframe.cancelbutton.configure(state="normal")
+        self.scanner.start()
+        self.after(100,self.poll_scan)
+    def cancel_scan(self):
+        if self.scanner:
+            self.scanner.cancel.set()
+            self.progressframe.cancelbutton.configure(state="disabled")
+    def poll_scan(self):
+        refresh = False
+        finished = False
+        while True:
+            try:
+                kind,stats = self.scan_events.get_nowait()
+            except queue.Empty:
+                break
+            if kind == "error":
+                self.progressframe.status.set("scan failed: {}".format(stats))
+                finished = True
+                continue
+            self.progressframe.update_view(kind,stats)
+            if kind in ("commit","done","cancelled"):
+                refresh = True
+            if kind in ("done","cancelled"):
+                finished = True
+        if refresh:
+            self.update_ui()
+        if finished:
+            self.scanner = None
+            self.progressframe.cancelbutton.configure(state="disabled")
+        else:
+            self.after(100,self.poll_scan)
+    def start_fileop(self,op,paths,target):
+        if self.fileop:
+            return
+        self.fileop = FileOperation(self.fileop_events,op,paths,target,_DBFILE)
+        self.fileopframe.pack(fill="x",expand=False)
+        self.fileopframe.cancelbutton.configure(state="normal")
+        self.fileop.start()
+        self.after(100,self.poll_fileop)
+    def start_keyfix(self):
+        if self.fileop:
+            return
+        paths = self.mainframe.dataframe.selected_paths()
+        items = self.db.cx.key_fixes(paths or None)
+        if not items:
+            messagebox.showinfo("Fix key signatures","No {} files with an estimated key.".format(
+                "selected" if paths else "mismatched"))
+            return
+        if not messagebox.askyesno("Fix key signatures","Write the estimated key signature into {} {}files?".format(
+                len(items),"" if paths else "mismatched ")):
+            return
+        self.fileop = KeyWriter(self.fileop_events,items,_DBFILE,jobs=ns.jobs)
+        self.fileopframe.pack(fill="x",expand=False)
+        self.fileopframe.cancelbutton.configure(state="normal")
+        self.fileop.start()
+        self.after(100,self.poll_fileop)
+    def cancel_fileop(self):
+        if self.fileop:
+            self.fileop.cancel.set()
+            self.fileopframe.cancelbutton.configure(state="disabled")
+    def poll_fileop(self):
+        while True:
+            try:
+                kind,stats = self.fileop_events.get_nowait()
+            except queue.Empty:
+                break
+            if kind == "error":
+                self.fileopframe.status.set("failed: {}".format(stats))
+            else:
+                self.fileopframe.update_view(kind,stats)
+            if kind in ("done","cancelled","error"):
+                self.fileop = None
+                self.fileopframe.cancelbutton.configure(state="disabled")
+                if kind != "error":
+                    if stats["conflicts"]:
+                        ConflictsWindow(self,stats)
+                    if stats["op"] in ("move","keys"):
+                        self.update_ui()
+                return
+        self.after(100,self.poll_fileop)
+    def start_watch(self):
+        from midiwatch import LibraryWatcher
+        self.watcher = LibraryWatcher(self.watch_events,ns.rootdir,_DBFILE)
+        self.watcher.start()
+        self.after(500,self.poll_watch)
+    def poll_watch(self):
+        refresh = False
+        while True:
+            try:
+                kind,stats = self.watch_events.get_nowait()
+            except queue.Empty:
+                break
+            if kind == "error":
+                self.progressframe.pack(fill="x",expand=False)
+                self.progressframe.status.set("watching stopped: {}".format(stats))
+                return
+            midiprof.trace("changed:",*stats["paths"])
+            refresh = True
+        if refresh:
+            self.update_ui()
+        self.after(500,self.poll_watch)
     def update_ui(self):
-        print("Updating UI")
-        ff = self.mainframe.filterframe
-        ff.keyframe.update_view()
-        ff.notecountframe.update_view()
-        ff.different_notesframe.update_view()
-        ff.different_timesframe.update_view()
-        ff.trackcountframe.update_view()
-        self.mainframe.dataframe.update_view()
+        # everything that changes a filter or the data asks for a refresh;
+        # do it once, when tk is idle again
+        if self.refresh_pending is None:
+            self.refresh_pending = self.after_idle(self.refresh)
+    def refresh(self):
+        self.refresh_pending = None
+        with stage("refresh"):
+            ff = self.mainframe.filterframe
+            counts = self.queries("facet_counts",self.mainframe.filters())
+            with stage("render facets"):
+                for frame in ff.facetframes:
+                    frame.update_view(counts[frame.facet])
+            self.mainframe.dataframe.update_view()
     def __init__(self):
         super().__init__()
         self.geometry("1600x1200")
@@ -512,28 +814,25 @@ class App(tk.Tk):
         self.mainframe.pack(**pack_normal)
         self.actionframe = ActionFrame(self.bottomframe)
         self.actionframe.pack(fill="both",expand=True)
-        self.db = MidiLibrary()
+        self.progressframe = ProgressFrame(self.bottomframe)
+        self.fileopframe = FileOpFrame(self.bottomframe)
+        self.fileop_events = queue.Queue()
+        self.fileop = None
+        self.db = MidiLibrary(_DBFILE)
+        self.queries = QueryCache(self.db.cx)
+        self.refresh_pending = None
+        self.scan_events = queue.Queue()
+        self.scanner = None
+        self.watch_events = queue.Queue()
+        self.watcher = None
         if ns.scan:
-            self.db.cx.populate_from(ns.rootdir)
-        self.update_ui()
-        ff = self.mainframe.filterframe
-        ff.keyframe.listbox.selection_set(0)
-        ff.keyframe.listbox.event_generate("<<ListboxSelect>>")
-
-        ff.notecountframe.listbox.selection_set(0)
-        ff.notecountframe.listbox.event_generate("<<ListboxSelect>>")
-
-        ff.different_notesframe.listbox.selection_set(0)
-        ff.different_notesframe.listbox.event_generate("<<ListboxSelect>>")
-
-        ff.different_timesframe.listbox.selection_set(0)
-        ff.different_timesframe.listbox.event_generate("<<ListboxSelect>>")
-
-        ff.trackcountframe.listbox.selection_set(0)
-        ff.trackcountframe.listbox.event_generate("<<ListboxSelect>>")
-        
-        list(map(print,self.db.cx.iterdump()))
-        print("Remember: run with --scan at least once!")
+            self.start_scan()
+        if ns.watch:
+            self.start_watch()
+        # show the window first, the first round of queries can take a moment
+        self.update_idletasks()
+        self.after(1,self.update_ui)
+        print("Remember: run with --scan at least once! (--watch keeps it current after that)")
 # }}}1
 
 if __name__ == "__main__":
@@ -0,0 +1,1318 @@
+import os
+import sys
+import errno
+import shutil
+import sqlite3
+import tempfile
+import pathlib
+import ast
+import re
+import hashlib
+import json
+import io
+import posixpath
+import zipfile
+import bisect
+import collections
+import array
+import struct
+import concurrent.futures
+import threading
+import time
+import warnings
+import midiprof
+from midiprof import stage
+
+# {{{1 variables, utility functions
+here = pathlib.Path(__file__).parent
+
+_DBFILE = here / "midis.db"
+
+pitch_names = ("C","C#","D","D#","E","F","F#","G","G#","A","A#","B")
+
+def pitch_mask(names):
+    return sum(1 << pitch_names.index(n) for n in set(names))
+
+ANYKEY = "*ANY*"
+
+facet_columns = (
+    "keys","notecount","different_notes","different_times","tracks",
+    "est_key","key_mismatch")
+
+range_columns = ("notecount","different_notes","different_times","tracks")
+
+def bucket_edges(lo,hi,buckets=24):
+    # One bucket per value when they fit, otherwise geometrically growing
+    # buckets so the many small counts don't all land in the first bar.
+    if hi - lo + 1 <= buckets:
+        return list(range(lo,hi + 2))
+    ratio = (hi - lo + 1) ** (1 / buckets)
+    edges = sorted({lo + round(ratio ** i) - 1 for i in range(buckets)} | {hi + 1})
+    return edges
+
+def histogram(counts,edges):
+    hist = [0] * max(0,len(edges) - 1)
+    for value,count in counts:
+        i = bisect.bisect_right(edges,value) - 1
+        if 0 <= i < len(hist):
+            hist[i] += count
+    return hist
+
+def search_query(text):
+    # Every word the user typed must prefix-match a word of the name or
+    # directory. Quoting keeps fts5 operators and punctuation literal.
+    return " ".join('"{}"*'.format(word) for word in re.findall(r"\w+",text))
+
+def parse_range(text):
+    # "5" stays "5", "2:8" -> (2,8), ":8" -> (None,8)
+    lo,sep,hi = text.partition(":")
+    try:
+        if not sep:
+            int(text)
+            return text
+        return (int(lo) if lo.strip() else None,int(hi) if hi.strip() else None)
+    except ValueError:
+        raise ValueError("expected a number or a lo:hi range, not {!r}".format(text)) from None
+
+midi_columns = (
+    "path","dir","name",
+    "keys","notecount","noteset","different_notes","different_times","tracks",
+    "errors",
+    "pchist","filehash","notehash",
+    "size","mtime","archive")
+
+def is_archive(name):
+    return name.lower().endswith(".zip")
+
+member_suffixes = (".mid",".midi")
+
+def split_member(path):
+    # "C:/packs/pack.zip!drums/groove.mid" -> ("C:/packs/pack.zip","drums/groove.mid")
+    i = path.lower().find(".zip!")
+    if i < 0:
+        return path,None
+    return path[:i+4],path[i+5:]
+
+def walk_midis(top):
+    stack = [top]
+    while stack:
+        d = stack.pop()
+        midiprof.trace("root:",d)
+        try:
+            with os.scandir(d) as it:
+                entries = list(it)
+        except OSError:
+            continue
+        subdirs = list()
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.path)
+            elif entry.name.endswith(".mid") or is_archive(entry.name):
+                yield entry
+        stack.extend(reversed(subdirs))
+
+ArchiveScan = collections.namedtuple("ArchiveScan","path size mtime error rows")
+
+def scan_archive(fpath,size,mtime):
+    # Members are read straight out of the zip into memory and get
+    # "archive!member" paths; nothing is extracted.
+    rows = list()
+    try:
+        with zipfile.ZipFile(fpath) as zf:
+            for info in zf.infolist():
+                if info.is_dir() or not info.filename.lower().endswith(member_suffixes):
+                    continue
+                folder,base = posixpath.split(info.filename)
+                row,grams = scan_data(
+                    "{}!{}".format(fpath,info.filename),
+                    "{}!{}".format(fpath,folder) if folder else fpath,
+                    posixpath.splitext(base)[0],
+                    lambda:zf.read(info))
+                rows.append(row + (info.file_size,mtime,fpath,grams))
+    except (OSError,zipfile.BadZipFile):
+        return ArchiveScan(fpath,size,mtime,str(sys.exc_info()[1]),rows)
+    return ArchiveScan(fpath,size,mtime,None,rows)
+
+def scan_task(task):
+    fpath,size,mtime,oldhash = task
+    if is_archive(fpath):
+        return scan_archive(fpath,size,mtime)
+    data = None
+    if oldhash:
+        # read once: the bytes we hash are the bytes we parse if it changed
+        try:
+            with stage("read"):
+                data = pathlib.Path(fpath).read_bytes()
+        except OSError:
+            pass
+        else:
+            with stage("hash file"):
+                same = oldhash == hashlib.blake2b(data,digest_size=16).hexdigest()
+            if same:
+                return (mtime,fpath)
+    row,grams = scan_midi(fpath,data)
+    return row + (size,mtime,None,grams)
+
+key_names = {
+    (-7,0):"Cb",(-6,0):"Gb",(-5,0):"Db",(-4,0):"Ab",(-3,0):"Eb",(-2,0):"Bb",(-1,0):"F",
+    (0,0):"C",(1,0):"G",(2,0):"D",(3,0):"A",(4,0):"E",(5,0):"B",(6,0):"F#",(7,0):"C#",
+    (-7,1):"Abm",(-6,1):"Ebm",(-5,1):"Bbm",(-4,1):"Fm",(-3,1):"Cm",(-2,1):"Gm",(-1,1):"Dm",
+    (0,1):"Am",(1,1):"Em",(2,1):"Bm",(3,1):"F#m",(4,1):"C#m",(5,1):"G#m",(6,1):"D#m",(7,1):"A#m"}
+
+key_tonics = {
+    name:((sf * 7 + 9 * mi) % 12,mi) for (sf,mi),name in key_names.items()}
+
+estimate_names = (
+    "C","Db","D","Eb","E","F","F#","G","Ab","A","Bb","B",
+    "Cm","C#m","Dm","Ebm","Em","Fm","F#m","Gm","G#m","Am","Bbm","Bm")
+
+# Krumhansl-Kessler key profiles, tonic first
+major_profile = (6.35,2.23,3.48,2.33,4.38,4.09,2.52,5.19,2.39,3.66,2.29,2.88)
+minor_profile = (6.33,2.68,3.52,5.38,2.60,3.53,2.54,4.75,3.98,2.69,3.34,3.17)
+
+def estimate_keys(histograms):
+    import numpy
+    h = numpy.frombuffer(b"".join(histograms),dtype="<f4").reshape(-1,12).astype(numpy.float64)
+    profiles = numpy.array([
+        numpy.roll(profile,tonic)
+        for profile in (major_profile,minor_profile)
+        for tonic in range(12)])
+    h -= h.mean(axis=1,keepdims=True)
+    profiles -= profiles.mean(axis=1,keepdims=True)
+    with numpy.errstate(invalid="ignore",divide="ignore"):
+        scores = (h @ profiles.T) / (
+            numpy.linalg.norm(h,axis=1,keepdims=True) * numpy.linalg.norm(profiles,axis=1))
+    best = scores.argmax(axis=1)
+    return best.tolist(),scores[numpy.arange(len(best)),best].tolist()
+
+def key_mismatch(keys,est_key):
+    if not keys or keys == "NONE":
+        return None
+    return int(key_tonics[est_key] not in {key_tonics[k] for k in keys.split("_")})
+
+_MAX_MESSAGE_LENGTH = 1000000
+_DATA_BYTES = bytes(range(128))
+
+def smf_stats(data):
+    # Walks the chunks and events of a Standard MIDI File without building
+    # message objects.  Anything mido would not read the same way raises
+    # ValueError (or IndexError on truncation) so the caller can fall back.
+    buf = memoryview(data)
+    end = len(buf)
+    if buf[0:4] != b"MThd":
+        raise ValueError("MThd not found")
+    hsize = int.from_bytes(buf[4:8],"big")
+    if hsize < 6 or 8 + hsize > end:
+        raise ValueError("short header")
+    ntracks = int.from_bytes(buf[10:12],"big",signed=True)
+    division = int.from_bytes(buf[12:14],"big",signed=True)
+    pos = 8 + hsize
+    different_notes = set()
+    different_times = set()
+    key_sigs = set()
+    note_count = 0
+    tracks = 0
+    durations = [0] * 12
+    onsets = [0] * 12
+    notes = list()
+    for _ in range(ntracks):
+        if pos + 8 > end or buf[pos:pos+4] != b"MTrk":
+            raise ValueError("no MTrk header at start of track")
+        stop = pos + 8 + int.from_bytes(buf[pos+4:pos+8],"big")
+        pos += 8
+        if stop > end:
+            raise ValueError("track runs past end of file")
+        last_status = None
+        now = 0
+        sounding = dict()
+        while pos < stop:
+            delta = 0
+            while True:
+                byte = buf[pos]
+                pos += 1
+                delta = (delta << 7) | (byte & 0x7f)
+                if byte < 0x80:
+                    break
+            now += delta
+            status = buf[pos]
+            if status < 0x80:
+                if last_status is None:
+                    raise ValueError("running status without last_status")
+                status = last_status
+            else:
+                pos += 1
+                if status != 0xff:
+                    last_status = status
+            if status < 0xf0:
+                kind = status & 0xf0
+                if kind == 0x90 or kind == 0x80:
+                    note = buf[pos]
+                    velocity = buf[pos+1]
+                    if note > 127 or velocity > 127:
+                        raise ValueError("data byte out of range")
+                    if kind == 0x90:
+                        different_notes.add(note)
+                        different_times.add(delta)
+                        note_count += 1
+                    voice = (status & 0x0f) << 7 | note
+                    if kind == 0x90 and velocity:
+                        sounding.setdefault(voice,list()).append(now)
+                        onsets[note % 12] += 1
+                        notes.append((now,note))
+                    elif sounding.get(voice):
+                        durations[note % 12] += now - sounding[voice].pop(0)
+                    pos += 2
+                elif kind == 0xc0 or kind == 0xd0:
+                    if buf[pos] > 127:
+                        raise ValueError("data byte out of range")
+                    pos += 1
+                else:
+                    if buf[pos] > 127 or buf[pos+1] > 127:
+                        raise ValueError("data byte out of range")
+                    pos += 2
+                continue
+            if status == 0xff:
+                meta_type = buf[pos]
+                pos += 1
+            elif status == 0xf0 or status == 0xf7:
+                meta_type = None
+            else:
+                raise ValueError("unhandled status byte")
+            length = 0
+            while True:
+                byte = buf[pos]
+                pos += 1
+                length = (length << 7) | (byte & 0x7f)
+                if byte < 0x80:
+                    break
+            if length > _MAX_MESSAGE_LENGTH:
+                raise ValueError("message too long")
+            if meta_type is None:
+                body = bytes(buf[pos:pos+length])
+                if body[:1] == b"\xf0":
+                    body = body[1:]
+                if body[-1:] == b"\xf7":
+                    body = body[:-1]
+                if body.translate(None,_DATA_BYTES):
+                    raise ValueError("sysex data byte out of range")
+            elif meta_type == 0x59:
+                if length != 2:
+                    raise ValueError("bad key_signature")
+                sf = buf[pos]
+                key_sigs.add(key_names[(sf - 256 if sf > 127 else sf,buf[pos+1])])
+            pos += length
+        if pos != stop:
+            raise ValueError("event runs past end of track")
+        for voice,starts in sounding.items():
+            for start in starts:
+                durations[(voice & 0x7f) % 12] += now - start
+        tracks += 1
+    return (tracks,note_count,different_notes,different_times,key_sigs,
+            pitch_histogram(durations,onsets),notes,division)
+
+def mido_stats(mid):
+    different_notes = set()
+    different_times = set()
+    key_sigs = set()
+    note_count = 0
+    durations = [0] * 12
+    onsets = [0] * 12
+    notes = list()
+    for track in mid.tracks:
+        now = 0
+        sounding = dict()
+        for message in track:
+            now += message.time
+            if message.type == "key_signature":
+                key_sigs.add(message.key)
+            if message.type == "note_on":
+                different_notes.add(message.note)
+                different_times.add(message.time)
+                note_count += 1
+            if message.type in ("note_on","note_off"):
+                voice = (message.channel,message.note)
+                if message.type == "note_on" and message.velocity:
+                    sounding.setdefault(voice,list()).append(now)
+                    onsets[message.note % 12] += 1
+                    notes.append((now,message.note))
+                elif sounding.get(voice):
+                    durations[message.note % 12] += now - sounding[voice].pop(0)
+        for (channel,note),starts in sounding.items():
+            for start in starts:
+                durations[note % 12] += now - start
+    return (len(mid.tracks),note_count,different_notes,different_times,key_sigs,
+            pitch_histogram(durations,onsets),notes,mid.ticks_per_beat)
+
+def pitch_histogram(durations,onsets):
+    weights = durations if any(durations) else onsets
+    total = sum(weights)
+    if not total:
+        return None
+    return struct.pack("<12f",*(w / total for w in weights))
+
+def note_hash(notes,division):
+    # Onsets merged across tracks and channels, in quarter-note units where
+    # the division allows it, so renamed/retempo'd/re-tracked copies match.
+    if not notes:
+        return None
+    if division > 0:
+        notes = [(tick * 960 // division,note) for tick,note in notes]
+    keys = array.array("Q",sorted(tick << 7 | note for tick,note in notes))
+    if sys.byteorder == "big":
+        keys.byteswap()
+    return hashlib.blake2b(keys.tobytes(),digest_size=16).hexdigest()
+
+def melody_ngrams(notes,n=4,keep=96):
+    # Highest note at each onset, as n successive intervals packed 7 bits
+    # apiece, so the grams do not depend on transposition.  Only the `keep`
+    # grams with the smallest hash are indexed (a bottom-k sketch): files
+    # sharing material still share sketch entries, and the index stays small.
+    top = dict()
+    for tick,note in notes:
+        if note > top.get(tick,-1):
+            top[tick] = note
+    melody = [top[tick] for tick in sorted(top)]
+    grams = set()
+    mask = (1 << 7 * n) - 1
+    gram = 0
+    for i,(a,b) in enumerate(zip(melody,melody[1:])):
+        step = b - a
+        gram = (gram << 7 | (127 if step > 63 else 1 if step < -63 else step + 64)) & mask
+        if i >= n - 1:
+            grams.add(gram)
+    if len(grams) > keep:
+        grams = sorted(grams,key=lambda gram:(gram * 0x9e3779b1) & 0xffffffff)[:keep]
+    return sorted(grams)
+
+def scan_midi(fpath,data=None):
+    fpath = pathlib.Path(fpath)
+    return scan_data(str(fpath),str(fpath.parent),str(fpath.stem),
+                     fpath.read_bytes if data is None else lambda:data)
+
+def scan_data(path,_dir,name,read):
+    filehash = None
+    try:
+        with stage("read"):
+            data = read()
+        filehash = hashlib.blake2b(data,digest_size=16).hexdigest()
+        with stage("parse"):
+            try:
+                stats = smf_stats(data)
+            except (ValueError,IndexError,KeyError):
+                # mido is slow to import and only needed for odd files
+                import mido
+                midiprof.count("mido fallback")
+                stats = mido_stats(mido.MidiFile(file=io.BytesIO(data)))
+    except Exception:
+        return (path,_dir,name,None,None,None,None,None,None,str(sys.exc_info()[1]),None,filehash,None),[]
+    tracks,note_count,different_notes,different_times,key_sigs,pchist,notes,division = stats
+    with stage("fingerprint"):
+        notehash = note_hash(notes,division)
+        grams = melody_ngrams(notes)
+    if not len(key_sigs):
+        key_sigs.add("NONE")
+    return (
+        path,
+        _dir,
+        name,
+        "_".join(sorted(key_sigs)),
+        note_count,
+        pitch_mask(pitch_names[n % 12] for n in different_notes),
+        len(different_notes),
+        len(different_times),
+        tracks,
+        None,
+        pchist,
+        filehash,
+        notehash),grams
+
+# }}}1
+# {{{1 key signature rewriting
+
+key_codes = {name:code for code,name in key_names.items()}
+
+def key_signature_offsets(data):
+    # Where the data bytes of every key_signature meta event are, and
+    # where the first track's header is. Same walk as smf_stats without
+    # looking at the events, and the same refusal of anything odd.
+    buf = memoryview(data)
+    end = len(buf)
+    if buf[0:4] != b"MThd":
+        raise ValueError("MThd not found")
+    hsize = int.from_bytes(buf[4:8],"big")
+    if hsize < 6 or 8 + hsize > end:
+        raise ValueError("short header")
+    ntracks = int.from_bytes(buf[10:12],"big",signed=True)
+    pos = 8 + hsize
+    first_track = pos
+    offsets = list()
+    for _ in range(ntracks):
+        if pos + 8 > end or buf[pos:pos+4] != b"MTrk":
+            raise ValueError("no MTrk header at start of track")
+        stop = pos + 8 + int.from_bytes(buf[pos+4:pos+8],"big")
+        pos += 8
+        if stop > end:
+            raise ValueError("track runs past end of file")
+        last_status = None
+        while pos < stop:
+            while buf[pos] >= 0x80:
+                pos += 1
+            pos += 1
+            status = buf[pos]
+            if status < 0x80:
+                if last_status is None:
+                    raise ValueError("running status without last_status")
+                status = last_status
+            else:
+                pos += 1
+                if status != 0xff:
+                    last_status = status
+            if status < 0xf0:
+                pos += 1 if (status & 0xf0) in (0xc0,0xd0) else 2
+                continue
+            if status == 0xff:
+                meta_type = buf[pos]
+                pos += 1
+            elif status == 0xf0 or status == 0xf7:
+                meta_type = None
+            else:
+                raise ValueError("unhandled status byte")
+            length = 0
+            while True:
+                byte = buf[pos]
+                pos += 1
+                length = (length << 7) | (byte & 0x7f)
+                if byte < 0x80:
+                    break
+            if meta_type == 0x59:
+                if length != 2:
+                    raise ValueError("bad key_signature")
+                offsets.append(pos)
+            pos += length
+        if pos != stop:
+            raise ValueError("event runs past end of track")
+    if not ntracks:
+        raise ValueError("no tracks")
+    return first_track,offsets
+
+def rewrite_key_signature(data,key):
+    # Existing key signatures are overwritten in place (same length, so
+    # nothing else moves); a file without one gets it at time 0 at the
+    # start of the first track, whose length header grows by 6.
+    sf,mi = key_codes[key]
+    sig = bytes((sf & 0xff,mi))
+    first_track,offsets = key_signature_offsets(data)
+    out = bytearray(data)
+    if offsets:
+        for offset in offsets:
+            out[offset:offset+2] = sig
+        return bytes(out)
+    length = int.from_bytes(out[first_track+4:first_track+8],"big")
+    out[first_track+4:first_track+8] = (length + 6).to_bytes(4,"big")
+    out[first_track+8:first_track+8] = b"\x00\xff\x59\x02" + sig
+    return bytes(out)
+
+def rewrite_task(task):
+    # -> (path,None,size,mtime,filehash) or (path,error)
+    fpath,key = task
+    if split_member(fpath)[1] is not None:
+        return (fpath,"inside a zip archive")
+    tmp = None
+    try:
+        with open(fpath,"rb") as f:
+            data = f.read()
+        new = rewrite_key_signature(data,key)
+        if smf_stats(new)[4] != {key}:
+            raise ValueError("rewritten file does not read back as {}".format(key))
+        fd,tmp = tempfile.mkstemp(dir=os.path.dirname(fpath),prefix=".",suffix=".tmp")
+        with os.fdopen(fd,"wb") as f:
+            f.write(new)
+        shutil.copymode(fpath,tmp)
+        os.replace(tmp,fpath)
+        tmp = None
+        st = os.stat(fpath)
+    except (OSError,ValueError,IndexError,KeyError):
+        return (fpath,str(sys.exc_info()[1]))
+    finally:
+        if tmp is not None:
+            os.unlink(tmp)
+    return (fpath,None,st.st_size,st.st_mtime_ns,hashlib.blake2b(new,digest_size=16).hexdigest())
+
+def rewrite_chunk(tasks):
+    return [rewrite_task(task) for task in tasks]
+
+# }}}1
+# {{{1 MidiLibrarian
+class MidiLibrarian(sqlite3.Connection):
+    ddl = """
+    create table if not exists midis (
+    id integer primary key,
+    path text,
+    dir text,
+    name text,
+    keys text,
+    notecount integer,
+    noteset integer,
+    different_notes integer,
+    different_times integer,
+    tracks integer,
+    errors text,
+    size integer,
+    mtime integer,
+    filehash text,
+    pchist blob,
+    est_key text,
+    key_confidence real,
+    key_mismatch integer,
+    notehash text,
+    archive text,
+    unique (path) on conflict replace);
+    create table if not exists archives (
+    path text primary key,
+    size integer,
+    mtime integer,
+    members integer,
+    errors text) without rowid;
+    create table if not exists ngrams (
+    gram integer,
+    midi_id integer,
+    primary key (gram,midi_id)) without rowid;
+    create index if not exists ngrams_midi on ngrams (midi_id);
+    create trigger if not exists midis_ngrams_delete after delete on midis begin
+    delete from ngrams where midi_id=old.id;
+    end;
+    create table if not exists pcmasks (mask integer primary key);
+    insert into pcmasks
+    with recursive m(mask) as (select 0 union all select mask+1 from m where mask<4095)
+    select mask from m where not exists (select 1 from pcmasks);
+    """
+    index_ddl = """
+    create index if not exists midis_noteset on midis (noteset);
+    create index if not exists midis_filehash on midis (filehash);
+    create index if not exists midis_notehash on midis (notehash);
+    create index if not exists midis_archive on midis (archive);
+    """
+    facet_ddl = """
+    create table if not exists facets (
+    facet text,
+    value,
+    count integer,
+    primary key (facet,value)) without rowid;
+    """
+    fts_ddl = """
+    create virtual table if not exists midis_fts using fts5 (
+    name,dir,content='midis',content_rowid='id',prefix='2 3');
+    drop trigger if exists midis_fts_insert;
+    drop trigger if exists midis_fts_delete;
+    drop trigger if exists midis_fts_update;
+    create trigger midis_fts_insert after insert on midis begin
+    insert into midis_fts (rowid,name,dir) values (new.id,new.name,new.dir);
+    end;
+    create trigger midis_fts_delete after delete on midis begin
+    insert into midis_fts (midis_fts,rowid,name,dir) values ('delete',old.id,old.name,old.dir);
+    end;
+    create trigger midis_fts_update after update of name,dir on midis begin
+    insert into midis_fts (midis_fts,rowid,name,dir) values ('delete',old.id,old.name,old.dir);
+    insert into midis_fts (rowid,name,dir) values (new.id,new.name,new.dir);
+    end;
+    insert into midis_fts (midis_fts) values ('rebuild');
+    """
+    added_columns = (
+        ("size","integer"),
+        ("mtime","integer"),
+        ("filehash","text"),
+        ("pchist","blob"),
+        ("est_key","text"),
+        ("key_confidence","real"),
+        ("key_mismatch","integer"),
+        ("notehash","text"),
+        ("archive","text"))
+    schema_version = 8
+    @staticmethod
+    def facet_triggers():
+        index = "create index if not exists midis_{0} on midis ({0});"
+        # Every statement finds its facets row by primary key; the update
+        # trigger also skips columns whose value did not change.
+        add = (
+            "insert into facets select '{0}',new.{0},1 where new.{0} is not null{1}"
+            " on conflict (facet,value) do update set count=count+1;")
+        sub = "update facets set count=count-1 where facet='{0}' and value=old.{0}{1};"
+        prune = "delete from facets where facet='{0}' and value=old.{0} and count<=0{1};"
+        changed = " and old.{0} is not new.{0}"
+        def each(statement,only_changed=False):
+            return (statement.format(c,changed.format(c) if only_changed else "") for c in facet_columns)
+        return "\n".join([
+            *(index.format(c) for c in facet_columns),
+            "drop trigger if exists midis_facets_insert;",
+            "drop trigger if exists midis_facets_delete;",
+            "drop trigger if exists midis_facets_update;",
+            "create trigger if not exists midis_facets_insert after insert on midis begin",
+            *each(add),
+            "end;",
+            "create trigger if not exists midis_facets_delete after delete on midis begin",
+            *each(sub),
+            *each(prune),
+            "end;",
+            "create trigger if not exists midis_facets_update after update of {} on midis begin".format(
+                ",".join(facet_columns)),
+            *each(sub,True),
+            *each(add,True),
+            *each(prune,True),
+            "end;"])
+    def __init__(self,name,**kwargs):
+        super().__init__(name,**kwargs)
+        self.execute("pragma recursive_triggers=on")
+        self.executescript(self.ddl)
+        have = set(self.cu.execute("select name from pragma_table_info('midis')"))
+        for column,decl in self.added_columns:
+            if column not in have:
+                self.execute("alter table midis add column {} {}".format(column,decl))
+        version = next(self.cu.execute("pragma user_version"))
+        if version < self.schema_version:
+            if version < 3:
+                self.migrate_noteset()
+            self.executescript(self.facet_ddl + self.facet_triggers())
+            self.rebuild_facets()
+            self.executescript(self.fts_ddl)
+            if version < 5:
+                # rows scanned before histograms, note hashes and n-grams existed need a reparse
+                self.execute("update midis set mtime=null")
+            self.execute("pragma user_version={}".format(self.schema_version))
+        self.executescript(self.index_ddl)
+        self.commit()
+    def migrate_noteset(self):
+        # noteset used to be the text of a python list of note names
+        decl = next(self.cu.execute(
+            "select type from pragma_table_info('midis') where name='noteset'"))
+        if decl.lower() != "integer":
+            columns = ",".join(self.cu.execute("select name from pragma_table_info('midis')"))
+            self.execute("alter table midis rename to midis_old")
+            # the triggers went along with the rename; drop them so the ddl
+            # (and the facet and fts setup after us) creates them on the new table
+            for trigger in list(self.cu.execute(
+                    "select name from sqlite_master where type='trigger' and tbl_name='midis_old'")):
+                self.execute("drop trigger {}".format(trigger))
+            self.executescript(self.ddl +
+                "insert into midis ({0}) select {0} from midis_old;"
+                "drop table midis_old;".format(columns))
+        self.executemany(
+            "update midis set noteset=? where id=?",
+            [(pitch_mask(ast.literal_eval(text)),oid) for oid,text in self.execute(
+                "select id,noteset from midis where typeof(noteset)='text'")])
+    def rebuild_facets(self):
+        self.execute("delete from facets")
+        for c in facet_columns:
+            self.execute(
+                "insert into facets select '{0}',{0},count(*) from midis"
+                " where {0} is not null group by {0}".format(c))
+    @property
+    def cu(self):
+        cu = self.cursor()
+        cu.row_factory = lambda c,r:r[0]
+        return cu
+    def insert_midis(self,rows):
+        n = len(midi_columns)
+        self.executemany(
+            "insert into midis ({}) values ({})".format(
+                ",".join(midi_columns),
+                ",".join("?"*n)),
+            (row[:n] for row in rows))
+        # the new ids in one query rather than one lookup per file
+        ids = dict(self.execute(
+            "select path,id from midis where path in (select value from json_each(?))",
+            (json.dumps([row[0] for row in rows if len(row) > n and row[n]]),)))
+        # one statement per file rather than per gram; in id order the
+        # ngrams_midi index is only ever appended to
+        with stage("insert grams"):
+            self.executemany(
+                "insert or ignore into ngrams (gram,midi_id) select value,? from json_each(?)",
+                ((ids[row[0]],json.dumps(row[n])) for row in rows if len(row) > n and row[n]))
+    def store_result(self,result,rows,touched,archives,stats):
+        # nothing is written here: a write would hold the database locked
+        # until the batch commits, while the rest of the batch is parsed
+        if isinstance(result,ArchiveScan):
+            midiprof.trace("\tarchive:",result.path,len(result.rows))
+            stats["failed"] += (result.error is not None) + sum(
+                1 for row in result.rows if row[9] is not None)
+            archives.append(result)
+            rows.extend(result.rows)
+        elif len(result) == 2:
+            touched.append(result)
+        else:
+            midiprof.trace("\tfpath:",result[0])
+            if result[9] is not None:
+                stats["failed"] += 1
+            rows.append(result)
+    def write_batch(self,rows,touched,archives):
+        self.executemany("delete from midis where archive=?",((a.path,) for a in archives))
+        self.executemany(
+            "insert or replace into archives (path,size,mtime,members,errors) values (?,?,?,?,?)",
+            ((a.path,a.size,a.mtime,len(a.rows),a.error) for a in archives))
+        self.insert_midis(rows)
+        self.executemany("update midis set mtime=? where path=?",touched)
+    def populate_from(self,path,jobs=1,batchsize=2000,progress=None,cancel=None):
+        started = time.monotonic()
+        stats = dict(found=0,skipped=0,queued=0,parsed=0,failed=0,removed=0,rate=0.0,eta=None)
+        reported = [0.0]
+        def report(kind,force=False):
+            now = time.monotonic()
+            if progress and (force or now - reported[0] >= 0.1):
+                reported[0] = now
+                done = stats["parsed"]
+                if done:
+                    stats["rate"] = done / (now - started)
+                    stats["eta"] = (stats["queued"] - done) / stats["rate"]
+                progress(kind,dict(stats))
+        cancelled = lambda:cancel is not None and cancel.is_set()
+        # stored paths are absolute, however the root was spelled
+        top = os.path.abspath(path)
+        known = dict()
+        for fpath,size,mtime,filehash in self.execute(
+                "select path,size,mtime,filehash from midis where archive is null"):
+            if fpath.startswith(top + os.sep):
+                known[fpath] = (size,mtime,filehash)
+        for fpath,size,mtime in self.execute("select path,size,mtime from archives"):
+            if fpath.startswith(top + os.sep):
+                known[fpath] = (size,mtime,None)
+        seen = set()
+        tasks = list()
+        with stage("walk"):
+            for entry in walk_midis(top):
+                if cancelled():
+                    break
+                fpath = entry.path
+                seen.add(fpath)
+                stats["found"] += 1
+                report("walk")
+                try:
+                    st = entry.stat()
+                except OSError:
+                    tasks.append((fpath,None,None,None))
+                    continue
+                old = known.get(fpath)
+                if old and old[0] == st.st_size:
+                    if old[1] == st.st_mtime_ns:
+                        stats["skipped"] += 1
+                        continue
+                    oldhash = old[2]
+                else:
+                    oldhash = None
+                # a zip is one task; its members are parsed by the same worker
+                tasks.append((fpath,st.st_size,st.st_mtime_ns,oldhash))
+        stats["queued"] = len(tasks)
+        report("walk",force=True)
+        if cancelled():
+            tasks = list()
+        if jobs != 1 and len(tasks) > 1:
+            workers = jobs if jobs > 0 else os.cpu_count()
+            pool = concurrent.futures.ProcessPoolExecutor(workers)
+            chunksize = max(1,min(64,len(tasks)//(workers*8)))
+            # read and parse happen in the workers, all we see is the wait
+            results = midiprof.timed(pool.map(scan_task,tasks,chunksize=chunksize),"wait for workers")
+        else:
+            pool = None
+            results = map(scan_task,tasks)
+        try:
+            rows = list()
+            touched = list()
+            archives = list()
+            for result in results:
+                stats["parsed"] += 1
+                self.store_result(result,rows,touched,archives,stats)
+                if len(rows) + len(touched) >= batchsize:
+                    with stage("db insert"):
+                        self.write_batch(rows,touched,archives)
+                        self.commit()
+                    rows.clear()
+                    touched.clear()
+                    archives.clear()
+                    report("commit",force=True)
+                else:
+                    report("parse")
+                if cancelled():
+                    break
+            with stage("db insert"):
+                self.write_batch(rows,touched,archives)
+        finally:
+            if pool:
+                pool.shutdown(cancel_futures=True)
+        if cancelled():
+            self.commit()
+            report("cancelled",force=True)
+            return stats
+        gone = [(p,) for p in known if p not in seen]
+        stats["removed"] = len(gone)
+        with stage("db delete"):
+            self.executemany("delete from midis where path=?",gone)
+            self.executemany("delete from midis where archive=?",gone)
+            self.executemany("delete from archives where path=?",gone)
+            self.commit()
+        for key in ("found","skipped","parsed","failed","removed"):
+            midiprof.count("files " + key,stats[key])
+        try:
+            self.estimate_keys()
+        except ImportError:
+            warnings.warn("numpy is not installed, skipping key estimation")
+        self.execute("pragma optimize")
+        report("done",force=True)
+        return stats
+    def update_paths(self,paths):
+        # Bring just these paths up to date, for the watcher. A directory is
+        # rescanned as a whole; a path that no longer exists takes any rows
+        # below it along, since a deleted or moved directory arrives as one.
+        stats = dict(parsed=0,skipped=0,removed=0,failed=0)
+        tasks = list()
+        gone = list()
+        for fpath in sorted(set(os.path.abspath(p) for p in paths)):
+            try:
+                st = os.stat(fpath)
+            except OSError:
+                gone.append(fpath)
+                continue
+            if os.path.isdir(fpath):
+                found = self.populate_from(fpath)
+                for key in stats:
+                    stats[key] += found.get(key,0)
+                continue
+            if is_archive(fpath):
+                old = self.execute(
+                    "select size,mtime,null from archives where path=?",(fpath,)).fetchone()
+            elif fpath.endswith(".mid"):
+                old = self.execute(
+                    "select size,mtime,filehash from midis where path=?",(fpath,)).fetchone()
+            else:
+                continue
+            if old and old[0] == st.st_size:
+                if old[1] == st.st_mtime_ns:
+                    stats["skipped"] += 1
+                    continue
+                oldhash = old[2]
+            else:
+                oldhash = None
+            tasks.append((fpath,st.st_size,st.st_mtime_ns,oldhash))
+        rows = list()
+        touched = list()
+        archives = list()
+        for result in map(scan_task,tasks):
+            stats["parsed"] += 1
+            self.store_result(result,rows,touched,archives,stats)
+        self.write_batch(rows,touched,archives)
+        for fpath in gone:
+            below = (fpath,len(fpath) + 1,fpath + os.sep)
+            stats["removed"] += self.execute(
+                "delete from midis where path=? or substr(path,1,?)=?",below).rowcount
+            stats["removed"] += self.execute(
+                "delete from midis where archive=? or substr(archive,1,?)=?",below).rowcount
+            self.execute("delete from archives where path=? or substr(path,1,?)=?",below)
+        self.commit()
+        if rows:
+            try:
+                self.estimate_keys()
+            except ImportError:
+                pass
+        return stats
+    def key_fixes(self,paths=None):
+        # (path,estimated key) for the given files, or for every file whose
+        # key signature disagrees with its estimated key
+        if paths is None:
+            return list(self.execute(
+                "select path,est_key from midis where key_mismatch=1 and archive is null order by path"))
+        return [row for row in (self.execute(
+            "select path,est_key from midis where path=? and est_key is not null",(str(p),)).fetchone()
+            for p in paths) if row]
+    def write_key_signatures(self,items,jobs=1,progress=None,cancel=None):
+        # Rewrites the files (in worker processes for big batches) and
+        # records the new keys, sizes, mtimes and hashes in one transaction,
+        # so the scanner sees them as unchanged afterwards.
+        items = [(str(path),key) for path,key in items]
+        stats = dict(op="keys",total=len(items),done=0,failed=0,conflicts=list())
+        reported = [0.0]
+        def report(kind,force=False):
+            now = time.monotonic()
+            if progress and (force or now - reported[0] >= 0.1):
+                reported[0] = now
+                progress(kind,dict(stats,conflicts=list(stats["conflicts"])))
+        keys = dict(items)
+        updates = list()
+        def record(result):
+            if result[1] is None:
+                fpath,_,size,mtime,filehash = result
+                updates.append((keys[fpath],size,mtime,filehash,fpath))
+                stats["done"] += 1
+            else:
+                stats["failed"] += 1
+                stats["conflicts"].append(result)
+            report("keys")
+        cancelled = lambda:cancel is not None and cancel.is_set()
+        pool = None
+        try:
+            with stage("rewrite keys"):
+                if jobs != 1 and len(items) > 64:
+                    workers = jobs if jobs > 0 else os.cpu_count()
+                    pool = concurrent.futures.ProcessPoolExecutor(workers)
+                    size = max(1,min(64,len(items)//(workers*8)))
+                    futures = [pool.submit(rewrite_chunk,items[i:i+size]) for i in range(0,len(items),size)]
+                    for future in futures:
+                        if cancelled():
+                            for pending in futures:
+                                pending.cancel()
+                        # a chunk that started has rewritten its files, record them
+                        if not future.cancelled():
+                            for result in future.result():
+                                record(result)
+                else:
+                    for item in items:
+                        record(rewrite_task(item))
+                        if cancelled():
+                            break
+        finally:
+            if pool:
+                pool.shutdown(cancel_futures=True)
+            rows = list()
+            for key,size,mtime,filehash,fpath in updates:
+                est_key = next(self.cu.execute("select est_key from midis where path=?",(fpath,)),None)
+                rows.append((key,est_key and key_mismatch(key,est_key),size,mtime,filehash,fpath))
+            with self:
+                self.executemany(
+                    "update midis set keys=?,key_mismatch=?,size=?,mtime=?,filehash=? where path=?",
+                    rows)
+        report("cancelled" if cancelled() else "done",force=True)
+        return stats
+    def estimate_keys(self,batchsize=50000):
+        with stage("estimate keys"):
+            rows = list(self.execute(
+                "select id,pchist,keys from midis where pchist is not null and est_key is null"))
+            for start in range(0,len(rows),batchsize):
+                batch = rows[start:start+batchsize]
+                best,confidence = estimate_keys([pchist for oid,pchist,keys in batch])
+                updates = list()
+                for (oid,pchist,keys),k,c in zip(batch,best,confidence):
+                    if c == c:
+                        est_key = estimate_names[k]
+                        updates.append((est_key,c,key_mismatch(keys,est_key),oid))
+                self.executemany(
+                    "update midis set est_key=?,key_confidence=?,key_mismatch=? where id=?",
+                    updates)
+            self.commit()
+            return len(rows)
+    def filter_clauses(self,filters,skip=None):
+        whereclauses = list()
+        qargs = list()
+        for column in facet_columns:
+            value = filters.get(column,ANYKEY)
+            if column == skip or value in (ANYKEY,""):
+                continue
+            if isinstance(value,tuple):
+                lo,hi = value
+                if lo is not None:
+                    whereclauses.append("{}>=?".format(column))
+                    qargs.append(lo)
+                if hi is not None:
+                    whereclauses.append("{}<=?".format(column))
+                    qargs.append(hi)
+            else:
+                whereclauses.append("{}=?".format(column))
+                qargs.append(value)
+        if filters.get("pcs_only") is not None:
+            whereclauses.append("noteset in (select mask from pcmasks where mask&?=mask)")
+            qargs.append(filters["pcs_only"])
+        if filters.get("pcs_all"):
+            whereclauses.append("noteset in (select mask from pcmasks where mask&?=?)")
+            qargs.extend((filters["pcs_all"],filters["pcs_all"]))
+        search = search_query(filters.get("search",""))
+        if search:
+            whereclauses.append("id in (select rowid from midis_fts where midis_fts match ?)")
+            qargs.append(search)
+        return whereclauses,qargs
+    def facet_bounds(self,facet):
+        return self.execute(
+            "select min(value),max(value) from facets where facet=?",(facet,)).fetchone()
+    def facet_counts(self,filters):
+        counts = {c:list() for c in facet_columns}
+        if not self.filter_clauses(filters)[0]:
+            sql = "select facet,value,count from facets order by facet,value"
+            qargs = list()
+        else:
+            selects = list()
+            qargs = list()
+            for c in facet_columns:
+                whereclauses,cargs = self.filter_clauses(filters,skip=c)
+                selects.append(
+                    "select '{0}',{0},count(*) from midis where {1} group by {0}".format(
+                        c," and ".join(["{} is not null".format(c)] + whereclauses)))
+                qargs.extend(cargs)
+            sql = " union all ".join(selects) + " order by 1,2"
+        with stage("facet query"):
+            for facet,value,count in self.execute(sql,qargs):
+                counts[facet].append((value,count))
+        return counts
+    def datatree_view(self,filters):
+        whereclauses,qargs = self.filter_clauses(filters)
+        if not whereclauses:
+            sql = "select id,path,name from midis"
+        else:
+            sql = "select id,path,name from midis where {}".format(" and ".join(whereclauses))
+        midiprof.trace("sql:",sql)
+        midiprof.trace("qargs:",qargs)
+        with stage("view query"):
+            return list(self.execute(sql,qargs))
+    def duplicates_view(self,column="filehash"):
+        if column not in ("filehash","notehash"):
+            raise ValueError(column)
+        groups = dict()
+        with stage("duplicates query"):
+            for digest,oid,path,name in self.execute(
+                    "select {0},id,path,name from midis where {0} in"
+                    " (select {0} from midis where {0} is not null group by {0} having count(*)>1)"
+                    " order by {0},path".format(column)):
+                groups.setdefault(digest,list()).append((oid,path,name))
+        return groups
+    def similar_view(self,oid,limit=50,common=0.02):
+        # Grams shared by more than `common` of the library say nothing
+        # about similarity and would make the join huge, so skip them.
+        cutoff = max(50,int(next(self.cu.execute("select count(*) from midis")) * common))
+        with stage("similar query"):
+            return list(self.execute(
+                "with mine as (select gram from ngrams where midi_id=?),"
+                " useful as (select gram from mine"
+                "  where (select count(*) from ngrams n where n.gram=mine.gram) <= ?),"
+                " shared as (select n.midi_id,count(*) as score from ngrams n join useful using (gram)"
+                "  where n.midi_id!=? group by n.midi_id order by score desc limit ?)"
+                " select m.id,m.path,m.name,s.score from shared s join midis m on m.id=s.midi_id"
+                " order by s.score desc,m.path",
+                (oid,cutoff,oid,limit)))
+    def datatree_page(self,filters,after=None,before=None,reverse=False,limit=200):
+        whereclauses,qargs = self.filter_clauses(filters)
+        if after is not None:
+            whereclauses.append("id>?")
+            qargs.append(after)
+        if before is not None:
+            whereclauses.append("id<?")
+            qargs.append(before)
+        sql = "select id,path,name from midis{} order by id {} limit ?".format(
+            " where " + " and ".join(whereclauses) if whereclauses else "",
+            "desc" if reverse else "asc")
+        with stage("page query"):
+            rows = list(self.execute(sql,qargs + [limit]))
+        if reverse:
+            rows.reverse()
+        return rows
+    def datatree_count(self,filters):
+        whereclauses,qargs = self.filter_clauses(filters)
+        sql = "select count(*) from midis"
+        if whereclauses:
+            sql += " where " + " and ".join(whereclauses)
+        with stage("count query"):
+            return next(self.cu.execute(sql,qargs))
+    def datatree_paths(self,filters):
+        whereclauses,qargs = self.filter_clauses(filters)
+        sql = "select id,path from midis"
+        if whereclauses:
+            sql += " where " + " and ".join(whereclauses)
+        return list(self.execute(sql,qargs))
+    def datatree_selected(self,filters,ids,chunk=500):
+        # datatree_paths for just these ids
+        whereclauses,qargs = self.filter_clauses(filters)
+        ids = sorted(ids)
+        rows = list()
+        for i in range(0,len(ids),chunk):
+            part = ids[i:i+chunk]
+            sql = "select id,path from midis where " + " and ".join(
+                whereclauses + ["id in ({})".format(",".join("?"*len(part)))])
+            rows.extend(self.execute(sql,qargs + part))
+        return rows
+
+# }}}1
+# {{{1 QueryCache
+
+class QueryCache:
+    # Remembers the last few results of the MidiLibrarian query methods,
+    # keyed by method and arguments (a filters dict counts by its items). Anything committed since,
+    # from this connection or another (a scan, the watcher), empties it.
+    def __init__(self,cx,size=64):
+        self.cx = cx
+        self.size = size
+        self.results = collections.OrderedDict()
+        self.version = None
+    def __call__(self,method,*args,**kwargs):
+        version = (next(self.cx.cu.execute("pragma data_version")),self.cx.total_changes)
+        if version != self.version:
+            self.results.clear()
+            self.version = version
+        key = (method,tuple(tuple(sorted(a.items())) if isinstance(a,dict) else a for a in args),
+               tuple(sorted(kwargs.items())))
+        if key in self.results:
+            midiprof.count("cache hits")
+            self.results.move_to_end(key)
+            return self.results[key]
+        midiprof.count("cache misses")
+        result = self.results[key] = getattr(self.cx,method)(*args,**kwargs)
+        if len(self.results) > self.size:
+            self.results.popitem(last=False)
+        return result
+
+# }}}1
+# {{{1 MidiLibrary
+
+class MidiLibrary:
+    _handle = None
+    def __init__(self,dbfile=_DBFILE):
+        self.dbfile = dbfile
+    @property
+    def cx(self):
+        if not self._handle:
+            self._handle = sqlite3.connect(
+                self.dbfile,
+                factory=MidiLibrarian)
+            self._handle.execute("pragma journal_mode=wal")
+            self._handle.execute("pragma mmap_size=268435456")
+            self._handle.execute("pragma cache_size=-65536")
+        return self._handle
+
+# }}}1
+# {{{1 ScanWorker
+
+class ScanWorker(threading.Thread):
+    def __init__(self,events,rootdir,dbfile=_DBFILE,**options):
+        super().__init__(daemon=True)
+        self.events = events
+        self.rootdir = rootdir
+        self.dbfile = dbfile
+        self.options = options
+        self.cancel = threading.Event()
+    def run(self):
+        cx = MidiLibrary(self.dbfile).cx
+        try:
+            cx.populate_from(
+                self.rootdir,
+                progress=lambda kind,stats:self.events.put((kind,stats)),
+                cancel=self.cancel,
+                **self.options)
+        except Exception:
+            self.events.put(("error",str(sys.exc_info()[1])))
+        finally:
+            cx.close()
+
+# }}}1
+# {{{1 FileOperation
+
+class FileOperation(threading.Thread):
+    # Copies and moves files off the UI thread. Moves on the same
+    # filesystem are plain renames; everything else goes through a small
+    # thread pool. Moved rows get their new paths in one transaction.
+    def __init__(self,events,op,paths,target,dbfile=_DBFILE,workers=8):
+        super().__init__(daemon=True)
+        if op not in ("copy","move"):
+            raise ValueError(op)
+        self.events = events
+        self.op = op
+        self.paths = [pathlib.Path(p) for p in paths]
+        self.target = pathlib.Path(target)
+        self.dbfile = dbfile
+        self.workers = workers
+        self.cancel = threading.Event()
+    def run(self):
+        stats = dict(op=self.op,total=len(self.paths),done=0,failed=0,conflicts=list())
+        reported = [0.0]
+        def report(kind,force=False):
+            now = time.monotonic()
+            if force or now - reported[0] >= 0.1:
+                reported[0] = now
+                self.events.put((kind,dict(stats,conflicts=list(stats["conflicts"]))))
+        def problem(src,reason):
+            stats["failed"] += 1
+            stats["conflicts"].append((str(src),reason))
+            report(self.op)
+        try:
+            planned = set()
+            jobs = list()
+            for src in self.paths:
+                dest = self.target / src.name
+                if split_member(str(src))[1] is not None:
+                    problem(src,"inside a zip archive")
+                elif not src.is_file():
+                    problem(src,"missing")
+                elif dest in planned or dest.exists():
+                    problem(src,"{} already exists".format(dest))
+                else:
+                    planned.add(dest)
+                    jobs.append((src,dest))
+            moved = list()
+            pool = concurrent.futures.ThreadPoolExecutor(self.workers)
+            futures = dict()
+            try:
+                for src,dest in jobs:
+                    if self.cancel.is_set():
+                        break
+                    if self.op == "move":
+                        try:
+                            os.rename(src,dest)
+                        except OSError as e:
+                            if e.errno != errno.EXDEV:
+                                problem(src,e.strerror)
+                                continue
+                        else:
+                            moved.append((src,dest))
+                            stats["done"] += 1
+                            report(self.op)
+                            continue
+                        function = shutil.move
+                    else:
+                        function = shutil.copy2
+                    futures[pool.submit(function,src,dest)] = (src,dest)
+                for future in concurrent.futures.as_completed(futures):
+                    if self.cancel.is_set():
+                        for f in futures:
+                            f.cancel()
+                    if future.cancelled():
+                        continue
+                    src,dest = futures[future]
+                    try:
+                        future.result()
+                    except OSError as e:
+                        problem(src,e.strerror or str(e))
+                        continue
+                    if self.op == "move":
+                        moved.append((src,dest))
+                    stats["done"] += 1
+                    report(self.op)
+            finally:
+                pool.shutdown(cancel_futures=True)
+            if moved:
+                cx = MidiLibrary(self.dbfile).cx
+                try:
+                    with cx:
+                        cx.executemany(
+                            "update midis set path=?,dir=?,name=? where path=?",
+                            [(str(dest),str(dest.parent),dest.stem,str(src)) for src,dest in moved])
+                finally:
+                    cx.close()
+            report("cancelled" if self.cancel.is_set() else "done",force=True)
+        except Exception:
+            self.events.put(("error",str(sys.exc_info()[1])))
+
+# }}}1
+# {{{1 KeyWriter
+
+class KeyWriter(threading.Thread):
+    def __init__(self,events,items,dbfile=_DBFILE,jobs=1):
+        super().__init__(daemon=True)
+        self.events = events
+        self.items = items
+        self.dbfile = dbfile
+        self.jobs = jobs
+        self.cancel = threading.Event()
+    def run(self):
+        cx = MidiLibrary(self.dbfile).cx
+        try:
+            cx.write_key_signatures(
+                self.items,
+                jobs=self.jobs,
+                progress=lambda kind,stats:self.events.put((kind,stats)),
+                cancel=self.cancel)
+        except Exception:
+            self.events.put(("error",str(sys.exc_info()[1])))
+        finally:
+            cx.close()
+
+# }}}1
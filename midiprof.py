@@ -0,0 +1,113 @@
+import atexit
+import sys
+import time
+
+# {{{1 timers and counters
+
+enabled = False
+timers = dict()
+counters = dict()
+_trace = None
+_profiler = None
+_profile_out = None
+
+class _Stage:
+    __slots__ = ("name","start")
+    def __init__(self,name):
+        self.name = name
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+    def __exit__(self,*exc_info):
+        elapsed = time.perf_counter() - self.start
+        t = timers.get(self.name)
+        if t is None:
+            t = timers[self.name] = [0,0.0,0.0]
+        t[0] += 1
+        t[1] += elapsed
+        if elapsed > t[2]:
+            t[2] = elapsed
+
+class _Off:
+    __slots__ = ()
+    def __enter__(self):
+        return self
+    def __exit__(self,*exc_info):
+        pass
+
+_off = _Off()
+
+def stage(name):
+    # with stage("parse"): ...  -- a shared do-nothing object when off
+    if not enabled:
+        return _off
+    return _Stage(name)
+
+def count(name,n=1):
+    if enabled:
+        counters[name] = counters.get(name,0) + n
+
+def timed(iterable,name):
+    # time each next() of an iterator, e.g. results coming back from a pool
+    if not enabled:
+        return iterable
+    return _timed(iter(iterable),name)
+
+def _timed(iterator,name):
+    while True:
+        with stage(name):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+def trace(*args):
+    # what used to be debug prints; only written with --profile-trace
+    if _trace is not None:
+        print(*args,file=_trace)
+
+# }}}1
+# {{{1 setup and report
+
+def start(tracefile=None,cprofile=None):
+    global enabled,_trace,_profiler,_profile_out
+    enabled = True
+    if tracefile:
+        _trace = open(tracefile,"w",encoding="utf-8",errors="replace")
+    if cprofile:
+        import cProfile
+        _profiler = cProfile.Profile()
+        _profile_out = cprofile
+        _profiler.enable()
+
+def finish(file=None):
+    global _trace,_profiler
+    if _profiler is not None:
+        _profiler.disable()
+        _profiler.dump_stats(_profile_out)
+        _profiler = None
+    if _trace is not None:
+        _trace.close()
+        _trace = None
+    summary(file or sys.stderr)
+
+def summary(file=sys.stderr):
+    print("{:<24}{:>10}{:>12}{:>12}{:>12}".format("stage","calls","total s","mean ms","max ms"),file=file)
+    for name,(calls,total,longest) in sorted(timers.items(),key=lambda i:-i[1][1]):
+        print("{:<24}{:>10}{:>12.3f}{:>12.3f}{:>12.3f}".format(
+            name,calls,total,total / calls * 1000,longest * 1000),file=file)
+    for name,n in sorted(counters.items()):
+        print("{:<24}{:>10}".format(name,n),file=file)
+
+def add_arguments(parser):
+    parser.add_argument("--profile",action="store_true",help="print per-stage timings and counters on exit")
+    parser.add_argument("--profile-trace",default=None,help="with --profile, write the detailed trace to this file")
+    parser.add_argument("--cprofile",default=None,help="with --profile, write cProfile stats to this file")
+
+def setup(ns):
+    if ns.profile:
+        start(ns.profile_trace,ns.cprofile)
+        atexit.register(finish)
+
+# }}}1
@@ -0,0 +1,235 @@
+import os
+import sys
+import select
+import struct
+import threading
+import time
+import warnings
+import ctypes
+import errno
+from midilib import MidiLibrary,is_archive,_DBFILE
+
+# {{{1 InotifyWatcher
+
+def collapse(paths):
+    # a directory gets rescanned with everything below it, so drop
+    # the paths inside it that came in the same batch
+    paths = set(paths)
+    kept = set()
+    for path in paths:
+        parent = os.path.dirname(path)
+        while parent not in paths and os.path.dirname(parent) != parent:
+            parent = os.path.dirname(parent)
+        if parent not in paths:
+            kept.add(path)
+    return kept
+
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+_event = struct.Struct("iIII")
+
+class WatchError(OSError):
+    pass
+
+class InotifyWatcher:
+    mask = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+            IN_DELETE | IN_DELETE_SELF | IN_ONLYDIR)
+    def __init__(self,top,settle=0.5):
+        if not sys.platform.startswith("linux"):
+            raise OSError("inotify needs linux")
+        self.libc = ctypes.CDLL(None,use_errno=True)
+        self.libc.inotify_add_watch.argtypes = (ctypes.c_int,ctypes.c_char_p,ctypes.c_uint32)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(),"inotify_init1")
+        self.top = str(top)
+        self.settle = settle
+        self.dirs = dict()
+        try:
+            self.watch_tree(self.top)
+        except Exception:
+            # closing the instance releases every watch it already holds
+            os.close(self.fd)
+            raise
+    def watch_tree(self,top):
+        stack = [top]
+        while stack:
+            d = stack.pop()
+            wd = self.libc.inotify_add_watch(self.fd,os.fsencode(d),self.mask)
+            if wd < 0:
+                error = ctypes.get_errno()
+                if error in (errno.ENOENT,errno.ENOTDIR):
+                    continue
+                # most likely out of watches (fs.inotify.max_user_watches);
+                # a directory we can't watch would be silently missed
+                raise WatchError(error,os.strerror(error),d)
+            self.dirs[wd] = d
+            try:
+                with os.scandir(d) as it:
+                    stack.extend(e.path for e in it if e.is_dir(follow_symlinks=False))
+            except OSError:
+                pass
+    def unwatch_tree(self,top):
+        for wd,d in list(self.dirs.items()):
+            if d == top or d.startswith(top + os.sep):
+                self.libc.inotify_rm_watch(self.fd,wd)
+                del self.dirs[wd]
+    def read_events(self,timeout):
+        changed = set()
+        if not select.select([self.fd],[],[],timeout)[0]:
+            return changed
+        try:
+            data = os.read(self.fd,1 << 16)
+        except BlockingIOError:
+            return changed
+        offset = 0
+        while offset < len(data):
+            wd,mask,cookie,length = _event.unpack_from(data,offset)
+            offset += _event.size
+            name = os.fsdecode(data[offset:offset+length].rstrip(b"\0"))
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                changed.add(self.top)
+                continue
+            if mask & IN_IGNORED:
+                self.dirs.pop(wd,None)
+                continue
+            d = self.dirs.get(wd)
+            if d is None or not name:
+                continue
+            path = os.path.join(d,name)
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    self.watch_tree(path)
+                elif mask & IN_MOVED_FROM:
+                    self.unwatch_tree(path)
+                changed.add(path)
+            elif (name.endswith(".mid") or is_archive(name)) and not mask & IN_CREATE:
+                # a created file is picked up by the close_write that follows
+                changed.add(path)
+        return changed
+    def poll(self,timeout):
+        changed = self.read_events(timeout)
+        # copies and saves come as bursts of events, collect the whole burst
+        while changed:
+            more = self.read_events(self.settle)
+            if not more:
+                break
+            changed |= more
+        return collapse(changed)
+    def close(self):
+        os.close(self.fd)
+
+# }}}1
+# {{{1 PollingWatcher
+
+class PollingWatcher:
+    def __init__(self,top,interval=2.0,full_interval=600.0):
+        self.top = str(top)
+        self.interval = interval
+        self.full_interval = full_interval
+        now = time.monotonic()
+        self.next_poll = now + interval
+        self.next_full = now + full_interval
+        self.dirs = self.stat_tree(self.top)
+    def stat_tree(self,top):
+        dirs = dict()
+        stack = [top]
+        while stack:
+            d = stack.pop()
+            try:
+                dirs[d] = os.stat(d).st_mtime_ns
+                with os.scandir(d) as it:
+                    stack.extend(e.path for e in it if e.is_dir(follow_symlinks=False))
+            except OSError:
+                pass
+        return dirs
+    def poll(self,timeout):
+        # wait at most `timeout` so the caller can stop us, but only look
+        # at the directories every `interval` seconds
+        wait = self.next_poll - time.monotonic()
+        if wait > timeout:
+            time.sleep(timeout)
+            return set()
+        time.sleep(max(0.0,wait))
+        now = time.monotonic()
+        self.next_poll = now + self.interval
+        if now >= self.next_full:
+            # files edited in place don't touch their directory's mtime,
+            # so once in a while let the caller stat everything
+            self.next_full = now + self.full_interval
+            self.dirs = self.stat_tree(self.top)
+            return {self.top}
+        changed = set()
+        for d,mtime in list(self.dirs.items()):
+            try:
+                now = os.stat(d).st_mtime_ns
+            except OSError:
+                del self.dirs[d]
+                changed.add(d)
+                continue
+            if now != mtime:
+                self.dirs.update(self.stat_tree(d))
+                changed.add(d)
+        return collapse(changed)
+    def close(self):
+        pass
+
+def make_watcher(top,**options):
+    try:
+        return InotifyWatcher(top)
+    except (OSError,AttributeError):
+        warnings.warn("inotify not available, polling directories instead: {}".format(sys.exc_info()[1]))
+        return PollingWatcher(top,**options)
+
+# }}}1
+# {{{1 LibraryWatcher
+
+class LibraryWatcher(threading.Thread):
+    def __init__(self,events,rootdir,dbfile=_DBFILE,**options):
+        super().__init__(daemon=True)
+        self.events = events
+        self.rootdir = os.path.abspath(rootdir)
+        self.dbfile = dbfile
+        self.options = options
+        self.stop = threading.Event()
+    def run(self):
+        cx = MidiLibrary(self.dbfile).cx
+        watcher = None
+        try:
+            watcher = make_watcher(self.rootdir,**self.options)
+            while not self.stop.is_set():
+                try:
+                    changed = watcher.poll(1.0)
+                except WatchError:
+                    # a new directory could not be watched; poll from now on
+                    # and catch up on whatever inotify may have missed
+                    warnings.warn("{}, polling directories instead".format(sys.exc_info()[1]))
+                    watcher.close()
+                    watcher = PollingWatcher(self.rootdir,**self.options)
+                    changed = {str(self.rootdir)}
+                if changed:
+                    stats = cx.update_paths(changed)
+                    # a full pass that found nothing is not worth a refresh
+                    if stats["parsed"] or stats["removed"] or stats["failed"]:
+                        stats["paths"] = sorted(changed)
+                        self.events.put(("watch",stats))
+        except Exception:
+            self.events.put(("error",str(sys.exc_info()[1])))
+        finally:
+            if watcher is not None:
+                watcher.close()
+            cx.close()
+
+# }}}1
@@ -0,0 +1,255 @@
+import hashlib
+import io
+import pathlib
+import random
+import sqlite3
+import threading
+import zipfile
+import pytest
+from midibench import chunk,synthetic_midi
+from midilib import (key_codes,key_names,key_signature_offsets,mido_stats,
+                     rewrite_key_signature,rewrite_task,smf_stats,scan_data,scan_task,MidiLibrarian)
+
+# {{{1 helpers
+
+def track(*events):
+    return chunk(b"MTrk",b"".join(events) + b"\x00\xff\x2f\x00")
+
+def header(ntracks):
+    return chunk(b"MThd",(1).to_bytes(2,"big") + ntracks.to_bytes(2,"big") + (480).to_bytes(2,"big"))
+
+def key_sig(key):
+    sf,mi = key_codes[key]
+    return bytes((0,0xff,0x59,2,sf & 0xff,mi))
+
+note = b"\x00\x90\x3c\x40\x60\x80\x3c\x40"
+
+def read_keys(data):
+    mido = pytest.importorskip("mido")
+    mid = mido.MidiFile(file=io.BytesIO(data))
+    return [m.key for t in mid.tracks for m in t if m.type == "key_signature"]
+
+def library_rows(prefix,count,seed=0):
+    # what scan_task hands to insert_midis, without touching the disk
+    rng = random.Random(seed)
+    rows = list()
+    for i in range(count):
+        data = synthetic_midi(rng,2,50)
+        row,grams = scan_data("/{}/{}.mid".format(prefix,i),"/" + prefix,str(i),lambda:data)
+        rows.append(row + (len(data),0,None,grams))
+    return rows
+
+# }}}1
+# {{{1 library database
+
+def test_concurrent_inserts(tmp_path):
+    # a scan batch holds the write lock while the watcher inserts too
+    dbfile = str(tmp_path / "midis.db")
+    scan = MidiLibrarian(dbfile)
+    watch = MidiLibrarian(dbfile,timeout=10,check_same_thread=False)
+    scan.insert_midis(library_rows("scan",20))
+    errors = list()
+    def insert():
+        try:
+            watch.insert_midis(library_rows("watch",20,seed=1))
+            watch.commit()
+        except Exception as e:
+            errors.append(e)
+    t = threading.Thread(target=insert)
+    t.start()
+    t.join(0.2)
+    scan.commit()
+    t.join()
+    assert errors == []
+    assert scan.execute("select count(*) from midis").fetchone() == (40,)
+    assert scan.execute(
+        "select count(*) from ngrams left join midis on id=midi_id where id is null").fetchone() == (0,)
+    assert scan.execute("select count(distinct midi_id) from ngrams").fetchone()[0] > 30
+    scan.close()
+    watch.close()
+
+baseline_ddl = """
+create table midis (
+id integer primary key,
+path text,
+dir text,
+name text,
+keys text,
+notecount integer,
+noteset text,
+different_notes integer,
+different_times integer,
+tracks integer,
+errors text,
+unique (path) on conflict replace);
+"""
+
+def test_baseline_database_migrates(tmp_path):
+    rng = random.Random(0)
+    lib = tmp_path / "lib"
+    lib.mkdir()
+    dbfile = str(tmp_path / "midis.db")
+    old = sqlite3.connect(dbfile)
+    old.executescript(baseline_ddl)
+    for i in range(30):
+        path = lib / "{}.mid".format(i)
+        path.write_bytes(synthetic_midi(rng,3,30))
+        old.execute(
+            "insert into midis (path,dir,name,keys,notecount,noteset,different_notes,different_times,tracks)"
+            " values (?,?,?,'C',1,?,1,1,1)",(str(path),str(lib),str(i),str(["C","E"])))
+    old.commit()
+    old.close()
+    cx = MidiLibrarian(dbfile)
+    triggers = {name for name, in cx.execute(
+        "select name from sqlite_master where type='trigger' and tbl_name='midis'")}
+    assert {"midis_ngrams_delete","midis_facets_insert","midis_facets_delete",
+            "midis_facets_update","midis_fts_insert","midis_fts_delete"} <= triggers
+    assert cx.execute("select distinct noteset from midis").fetchall() == [(0b10001,)]
+    (lib / "0.mid").unlink()
+    (lib / "1.mid").write_bytes(synthetic_midi(rng,3,30))
+    stats = cx.populate_from(str(lib))
+    assert stats["removed"] == 1
+    facets = sorted(cx.execute("select * from facets"))
+    cx.rebuild_facets()
+    assert facets == sorted(cx.execute("select * from facets"))
+    assert cx.execute(
+        "select count(*) from ngrams left join midis on id=midi_id where id is null").fetchone() == (0,)
+    cx.close()
+
+def test_changed_mtime_reads_the_file_once(tmp_path,monkeypatch):
+    path = tmp_path / "a.mid"
+    path.write_bytes(header(1) + track(note))
+    oldhash = scan_task((str(path),0,1,None))[11]
+    reads = list()
+    read_bytes = pathlib.Path.read_bytes
+    def counted(self):
+        reads.append(self)
+        return read_bytes(self)
+    monkeypatch.setattr(pathlib.Path,"read_bytes",counted)
+    assert scan_task((str(path),0,2,oldhash)) == (2,str(path))
+    assert len(reads) == 1
+    # same size, different notes
+    path.write_bytes(header(1) + track(note.replace(b"\x3c",b"\x3e")))
+    row = scan_task((str(path),0,3,oldhash))
+    assert row[11] != oldhash and row[4] == 1
+    assert len(reads) == 2
+
+def test_archive_results_wait_for_the_batch(tmp_path):
+    # parsing an archive must not lock the database for the watcher,
+    # file operations and key writer until the batch commits
+    rng = random.Random(0)
+    archive = tmp_path / "pack.zip"
+    with zipfile.ZipFile(archive,"w") as zf:
+        for i in range(3):
+            zf.writestr("songs/{}.mid".format(i),synthetic_midi(rng,2,20))
+    cx = MidiLibrarian(str(tmp_path / "midis.db"))
+    rows,touched,archives = list(),list(),list()
+    stats = dict(failed=0)
+    cx.store_result(scan_task((str(archive),1,1,None)),rows,touched,archives,stats)
+    assert not cx.in_transaction
+    cx.write_batch(rows,touched,archives)
+    cx.commit()
+    assert cx.execute("select members from archives").fetchall() == [(3,)]
+    assert cx.execute("select count(*) from midis where archive=?",(str(archive),)).fetchone() == (3,)
+    cx.close()
+
+def test_root_spelling_does_not_matter(tmp_path,monkeypatch):
+    rng = random.Random(0)
+    lib = tmp_path / "lib"
+    lib.mkdir()
+    for i in range(5):
+        (lib / "{}.mid".format(i)).write_bytes(synthetic_midi(rng,2,20))
+    monkeypatch.chdir(tmp_path)
+    cx = MidiLibrarian(str(tmp_path / "midis.db"))
+    cx.populate_from("lib")
+    (lib / "0.mid").unlink()
+    stats = cx.populate_from(str(lib.resolve()))
+    assert stats["skipped"] == 4
+    assert stats["removed"] == 1
+    assert cx.execute("select count(*) from midis").fetchone() == (4,)
+    cx.close()
+
+# }}}1
+# {{{1 key signature rewriting
+
+def test_replaces_every_existing_signature():
+    data = header(2) + track(key_sig("C"),note) + track(key_sig("Am"),note,key_sig("F"))
+    new = rewrite_key_signature(data,"Eb")
+    assert len(new) == len(data)
+    assert smf_stats(new)[4] == {"Eb"}
+    assert read_keys(new) == ["Eb","Eb","Eb"]
+
+def test_inserts_into_a_file_without_one():
+    data = header(2) + track(note) + track(note)
+    first_track,offsets = key_signature_offsets(data)
+    assert offsets == []
+    new = rewrite_key_signature(data,"F#m")
+    assert len(new) == len(data) + 6
+    old_length = int.from_bytes(data[first_track+4:first_track+8],"big")
+    assert int.from_bytes(new[first_track+4:first_track+8],"big") == old_length + 6
+    assert new[first_track+8:first_track+14] == key_sig("F#m")
+    assert smf_stats(new)[:4] == smf_stats(data)[:4]
+    assert read_keys(new) == ["F#m"]
+
+def test_refuses_what_the_fast_parser_refuses():
+    # running status with nothing to run on
+    bad = header(1) + track(b"\x00\x3c\x40")
+    with pytest.raises(ValueError):
+        smf_stats(bad)
+    with pytest.raises(ValueError):
+        rewrite_key_signature(bad,"C")
+
+def test_rewrite_task(tmp_path):
+    path = tmp_path / "a.mid"
+    path.write_bytes(header(1) + track(note))
+    result = rewrite_task((str(path),"Bb"))
+    assert result[1] is None
+    assert smf_stats(path.read_bytes())[4] == {"Bb"}
+    assert list(tmp_path.iterdir()) == [path]
+    bad = tmp_path / "b.mid"
+    bad.write_bytes(b"RIFF")
+    assert rewrite_task((str(bad),"C"))[1] is not None
+    assert bad.read_bytes() == b"RIFF"
+
+def test_rewrite_task_refuses_archive_members(tmp_path):
+    archive = tmp_path / "pack.zip"
+    path,error = rewrite_task((str(archive) + "!a.mid","C"))
+    assert error is not None
+    assert not archive.exists()
+
+def test_cancelled_key_writes_are_recorded(tmp_path):
+    # every file rewritten on disk before the cancel took effect has its
+    # new key and hash in the database
+    for i in range(2000):
+        (tmp_path / "{}.mid".format(i)).write_bytes(header(1) + track(note))
+    cx = MidiLibrarian(str(tmp_path / "midis.db"))
+    cx.populate_from(str(tmp_path))
+    cancel = threading.Event()
+    items = [(path,"D") for path, in cx.execute("select path from midis")]
+    stats = cx.write_key_signatures(items,jobs=2,progress=lambda kind,stats:cancel.set(),cancel=cancel)
+    assert 0 < stats["done"] < len(items)
+    written = 0
+    for path,keys,filehash in cx.execute("select path,keys,filehash from midis"):
+        assert filehash == hashlib.blake2b(open(path,"rb").read(),digest_size=16).hexdigest()
+        if smf_stats(open(path,"rb").read())[4] == {"D"}:
+            assert keys == "D"
+            written += 1
+    assert written == stats["done"]
+    cx.close()
+
+# }}}1
+# {{{1 fast parser
+
+def test_smf_stats_matches_mido():
+    mido = pytest.importorskip("mido")
+    rng = random.Random(0)
+    for _ in range(50):
+        data = synthetic_midi(rng,4,50)
+        assert smf_stats(data) == mido_stats(mido.MidiFile(file=io.BytesIO(data)))
+
+def test_every_key_survives_a_rewrite():
+    data = header(1) + track(note)
+    for key in key_names.values():
+        assert smf_stats(rewrite_key_signature(data,key))[4] == {key}
+
+# }}}1